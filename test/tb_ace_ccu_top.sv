@@ -139,6 +139,9 @@ module tb_ace_ccu_top #(
     // Logged cache state changes
     string diff_file_template     = {MemDir, "/cache_diff_%0d.txt"};
     string diff_main_mem          = {MemDir, "/main_mem_diff.txt"};
+    // Created at the end of the simulation
+    string sim_done_file          = {MemDir, "/sim_done"};
+    int sim_done_fd;
 
     ACE_BUS_DV #(
         .AXI_ADDR_WIDTH ( AxiAddrWidth      ),
@@ -286,7 +289,12 @@ module tb_ace_ccu_top #(
     end
 
     always @(*) begin
-        if (&end_of_sim) $finish();
+        if (&end_of_sim) begin
+            // Signal the end of the traces to the coherency check
+            sim_done_fd = $fopen(sim_done_file, "w");
+            $fclose(sim_done_fd);
+            $finish();
+        end
     end
 
     initial begin
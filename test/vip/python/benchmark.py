@@ -0,0 +1,405 @@
+from cache_coherency_test import CacheCoherencyTest
+from trace_gen import TraceGenerator
+from common import MemoryRange
+from trace_reader import CacheTraceCursor, MemTraceCursor
+from random import seed
+import numpy as np
+import platform
+import time
+import json
+import os
+
+
+def build_test(params, mem_bytes, target_dir, check_args=None):
+  """CacheCoherencyTest with one cached and shared memory range of
+  mem_bytes, like the one of RandomTest. No state is generated yet."""
+  test = CacheCoherencyTest(
+    **params,
+    **(check_args or {}),
+    target_dir=target_dir,
+    check=False,
+    debug=False,
+    log_file=os.path.join(target_dir, "cache_python.jsonl"),
+    log_format="jsonl")
+  test.add_memory_range(MemoryRange(
+    cached=True, shared=True, start_addr=0, end_addr=mem_bytes))
+  return test
+
+
+def timed(results, name, func, *args):
+  """Call func, adding its wall time and CPU time to results[name]."""
+  wall_start = time.perf_counter()
+  cpu_start = time.process_time()
+  value = func(*args)
+  result = results.setdefault(name, {"wall": [], "cpu": []})
+  result["wall"].append(time.perf_counter() - wall_start)
+  result["cpu"].append(time.process_time() - cpu_start)
+  return value
+
+
+def run_benchmark(params, mem_bytes, n_events, n_inited_lines, repeat,
+                  target_dir, bench_seed=1, check_args=None):
+  """Time the hot paths of the checker on a synthetic simulation.
+  Every repetition starts from the same seeded initial state. The traces
+  are generated in the first one.
+  Returns the report as a dict."""
+  os.makedirs(target_dir, exist_ok=True)
+  results = {}
+  trace_lines = None
+  for _ in range(repeat):
+    seed(bench_seed)
+    np.random.seed(bench_seed)
+    test = build_test(params, mem_bytes, target_dir, check_args)
+    test.generate_random_memory()
+    test.generate_random_transactions()
+    timed(results, "generate_random_caches",
+          test.generate_random_caches, n_inited_lines)
+    timed(results, "save_caches", test.save_caches)
+    timed(results, "save_memory", test.save_memory)
+    timed(results, "save_transactions", test.save_transactions)
+    if timed(results, "check_coherency", test.check_coherency):
+      raise Exception("The initial state is not coherent")
+    if trace_lines is None:
+      generator = TraceGenerator(test, seed=bench_seed)
+      trace_lines = timed(
+        results, "generate_traces", generator.generate, n_events)
+    errors = timed(results, "reconstruct_state", test.reconstruct_state)
+    test.events.close()
+    if errors:
+      raise Exception("Coherency errors in the synthetic traces, see "
+                      f"{os.path.join(target_dir, 'cache_python.jsonl')}")
+
+  for result in results.values():
+    result["min"] = min(result["wall"])
+    result["mean"] = sum(result["wall"]) / len(result["wall"])
+  n_lines = sum(trace_lines.values())
+  results["reconstruct_state"]["lines_per_s"] = \
+    n_lines / results["reconstruct_state"]["min"]
+  return {
+    "params": params,
+    "mem_bytes": mem_bytes,
+    "check_args": check_args or {},
+    "n_events": n_events,
+    "n_inited_lines": n_inited_lines,
+    "repeat": repeat,
+    "seed": bench_seed,
+    "trace_lines": {
+      os.path.basename(file): lines for file, lines in trace_lines.items()},
+    "results": results,
+    "python": platform.python_version(),
+    "numpy": np.__version__,
+  }
+
+
+def baseline_parse_cache(file):
+  """Tokenize a cache trace with the loop of CacheState.reconstruct_state
+  before the trace cursors, without updating a cache. It serves as the
+  reference of the parse benchmark."""
+  with open(file, "r") as state_file:
+    for line in state_file:
+      words = line.split()
+      addr = None
+      time = None
+      initiator = None
+      set = None
+      way = None
+      tag = None
+      status = None
+      data = None
+      modify = True
+      for word in words:
+        time_idx = word.find("TIME:")
+        initiator_idx = word.find("INITIATOR:")
+        addr_idx = word.find("ADDR:")
+        set_idx = word.find("SET:")
+        way_idx = word.find("WAY")
+        tag_idx = word.find("TAG:")
+        status_idx = word.find("STATUS:")
+        data_idx = word.find("DATA:")
+        payload = word.split(":")[1]
+        if time_idx != -1:
+          time = int(payload)
+        if addr_idx != -1:
+          addr = int(payload, 16)
+        if set_idx != -1:
+          set = int(payload)
+        if initiator_idx != -1:
+          initiator = bool(int(payload))
+        if way_idx != -1:
+          way = int(payload)
+        if tag_idx != -1:
+          tag = int(payload, 16)
+        if status_idx != -1:
+          status = [char == '1' for char in payload]
+          status.reverse()
+        if data_idx != -1:
+          data = [int(x, 16) for x in payload.strip("[]").split(",")]
+      if None in [time,initiator,set,way,tag,status,data]:
+        if None in [time, addr]:
+          raise Exception("Unexpected state")
+        modify = False
+
+
+def baseline_parse_mem(file):
+  """Tokenize a main memory trace with the loop of
+  MemoryState.reconstruct_mem before the trace cursors, without storing
+  the data. It serves as the reference of the parse benchmark."""
+  with open(file, "r") as mem_file:
+    for line in mem_file:
+      words = line.split()
+      time = -1
+      addr = None
+      data = None
+      for word in words:
+        t_idx = word.find("TIME:")
+        a_idx = word.find("ADDR:")
+        d_idx = word.find("DATA:")
+        payload = word.split(":")[1]
+        if t_idx != -1:
+          time = int(payload)
+        if a_idx != -1:
+          addr = int(payload, 16)
+        if d_idx != -1:
+          data = int(payload, 16)
+      if (addr is None) != (data is None):
+        raise Exception(
+          "Either data or addr provided without the other"
+        )
+
+
+def parse_file(cursor, file):
+  """Read a trace and parse it with the block parser of cursor at once."""
+  with open(file, "rb") as trace_file:
+    cursor.parse_block(trace_file.read(), 0)
+
+
+def pop_all(cursor):
+  """Consume all records of a cursor with pop, like merge_traces."""
+  pop = cursor.pop
+  while pop() is not None:
+    pass
+  cursor.close()
+
+
+def run_parse_benchmark(params, mem_bytes, n_events, n_inited_lines, repeat,
+                        target_dir, bench_seed=1):
+  """Time the trace parsers on synthetic traces, without replaying them.
+  For the first cache trace and the main memory trace, the tokenizer of
+  the replay before the trace cursors, reading and parsing the trace with
+  the block parser of a cursor, and consuming a cursor with pop are
+  timed. Returns the report as a dict."""
+  os.makedirs(target_dir, exist_ok=True)
+  seed(bench_seed)
+  np.random.seed(bench_seed)
+  test = build_test(params, mem_bytes, target_dir)
+  test.generate_random_memory()
+  test.generate_random_transactions()
+  test.generate_random_caches(n_inited_lines)
+  trace_lines = TraceGenerator(test, seed=bench_seed).generate(n_events)
+  test.events.close()
+  traces = [
+    ("cache", test.get_cache_trace_files()[0], CacheTraceCursor,
+     baseline_parse_cache),
+    ("mem", test.get_mem_trace_file(), MemTraceCursor, baseline_parse_mem),
+  ]
+  results = {}
+  for _ in range(repeat):
+    for kind, file, cursor_type, baseline_parse in traces:
+      timed(results, f"baseline_{kind}", baseline_parse, file)
+      timed(results, f"parse_block_{kind}", parse_file, cursor_type(file), file)
+      timed(results, f"pop_{kind}", pop_all, cursor_type(file))
+
+  for result in results.values():
+    result["min"] = min(result["wall"])
+    result["mean"] = sum(result["wall"]) / len(result["wall"])
+  for kind, file, _, _ in traces:
+    reference = results[f"baseline_{kind}"]["min"]
+    for name in [f"baseline_{kind}", f"parse_block_{kind}", f"pop_{kind}"]:
+      results[name]["lines_per_s"] = trace_lines[file] / results[name]["min"]
+      results[name]["speedup"] = reference / results[name]["min"]
+  return {
+    "params": params,
+    "mem_bytes": mem_bytes,
+    "n_events": n_events,
+    "n_inited_lines": n_inited_lines,
+    "repeat": repeat,
+    "seed": bench_seed,
+    "trace_lines": {
+      os.path.basename(file): lines for file, lines in trace_lines.items()},
+    "results": results,
+    "python": platform.python_version(),
+    "numpy": np.__version__,
+  }
+
+
+def compare_reports(report, baseline, tolerance):
+  """Returns a message for every step that got slower than in baseline
+  by more than tolerance (a fraction of the baseline time)."""
+  regressions = []
+  for name, result in report["results"].items():
+    if name not in baseline["results"]:
+      continue
+    base_time = baseline["results"][name]["min"]
+    if result["min"] > base_time * (1 + tolerance):
+      regressions.append(
+        f"{name}: {result['min']:.4f} s, baseline {base_time:.4f} s")
+  return regressions
+
+
+if __name__ == "__main__":
+  import argparse
+  import sys
+  parser = argparse.ArgumentParser(
+    description=('Time the generation of the initial state, its writers '
+                 'and the coherency check on synthetic traces')
+  )
+  parser.add_argument(
+    '--addr_width',
+    type=int,
+    default=32,
+    help='AXI address width'
+  )
+  parser.add_argument(
+    '--data_width',
+    type=int,
+    default=64,
+    help='AXI data width'
+  )
+  parser.add_argument(
+    '--word_width',
+    type=int,
+    default=64,
+    help='Width of a word in the cache'
+  )
+  parser.add_argument(
+    '--cacheline_words',
+    type=int,
+    default=4,
+    help='Number of words in a cacheline'
+  )
+  parser.add_argument(
+    '--ways',
+    type=int,
+    default=2,
+    help='Number of ways in the cache'
+  )
+  parser.add_argument(
+    '--sets',
+    type=int,
+    default=16,
+    help='Number of sets in the cache'
+  )
+  parser.add_argument(
+    '--n_caches',
+    type=int,
+    default=4,
+    help='Number of cached masters'
+  )
+  parser.add_argument(
+    '--n_transactions',
+    type=int,
+    default=100,
+    help='Number of transactions generated per cached master'
+  )
+  parser.add_argument(
+    '--mem_bytes',
+    type=int,
+    default=0x1000,
+    help='Size of the cached and shared main memory'
+  )
+  parser.add_argument(
+    '--n_inited_lines',
+    type=int,
+    default=100,
+    help='Number of cache lines generate_random_caches places'
+  )
+  parser.add_argument(
+    '--n_events',
+    type=int,
+    default=2000,
+    help='Number of transactions in the synthetic traces'
+  )
+  parser.add_argument(
+    '--repeat',
+    type=int,
+    default=3,
+    help='Number of times every step is timed, the fastest one is reported'
+  )
+  parser.add_argument(
+    '--seed',
+    type=int,
+    default=1,
+    help='Seed of the initial state and the traces'
+  )
+  parser.add_argument(
+    '--target_dir',
+    type=str,
+    default='build/benchmark',
+    help='Directory for the generated files'
+  )
+  parser.add_argument(
+    '--incremental',
+    action='store_true',
+    help="Only check the cache lines touched since the previous timestamp"
+  )
+  parser.add_argument(
+    '--batched_check',
+    action='store_true',
+    help="Check the cache lines of all caches at once with array operations"
+  )
+  parser.add_argument(
+    '--parse_only',
+    action='store_true',
+    help=("Only time the trace parsers, against the tokenizer of the "
+          "replay before the trace cursors (speedup in the report)")
+  )
+  parser.add_argument(
+    '--output',
+    type=str,
+    default=None,
+    help='File to write the JSON report to (default: stdout)'
+  )
+  parser.add_argument(
+    '--baseline',
+    type=str,
+    default=None,
+    help='JSON report to compare against. Exits with 1 on regressions.'
+  )
+  parser.add_argument(
+    '--tolerance',
+    type=float,
+    default=0.2,
+    help='Allowed slowdown against the baseline, as a fraction'
+  )
+  args = parser.parse_args()
+
+  params = {
+    name: getattr(args, name) for name in [
+      "addr_width", "data_width", "word_width", "cacheline_words", "ways",
+      "sets", "n_caches", "n_transactions"]
+  }
+  check_args = {
+    "incremental": args.incremental,
+    "batched_check": args.batched_check,
+  }
+  if args.parse_only:
+    report = run_parse_benchmark(
+      params, args.mem_bytes, args.n_events, args.n_inited_lines,
+      args.repeat, args.target_dir, args.seed)
+  else:
+    report = run_benchmark(
+      params, args.mem_bytes, args.n_events, args.n_inited_lines,
+      args.repeat, args.target_dir, args.seed, check_args)
+  report_json = json.dumps(report, indent=2)
+  if args.output is None:
+    print(report_json)
+  else:
+    with open(args.output, "w") as file:
+      file.write(report_json + "\n")
+
+  if args.baseline is not None:
+    with open(args.baseline) as file:
+      regressions = compare_reports(report, json.load(file), args.tolerance)
+    for regression in regressions:
+      print(f"Regression: {regression}", file=sys.stderr)
+    sys.exit(1 if regressions else 0)
@@ -1,18 +1,26 @@
 from cache_state import \
   CacheState, CachelineState, \
-  CachelineStateEnum, CacheSetFullException, \
-  StateBits
+  CachelineStateEnum, \
+  StateBits, VALID_MASK, STATE_LUT, COMPATIBILITY_LUT, \
+  OutstandingIndex, OutstandingSet
 from math import log2
 from typing import List
 from memory_state import MemoryState
-from common import MemoryRange
+from common import MemoryRange, SparsePages
+from trace_reader import \
+  merge_traces, CacheTraceCursor, MemTraceCursor, TraceBatch
+from trace_binary import BinaryCacheTraceCursor, BinaryMemTraceCursor
+from parallel_check import ParallelChecker, SegmentedChecker
+from metrics import Metrics
+from event_log import EventLog, LOG_FILES, LOG_FORMATS
 from transactions import \
   CacheTransactionSequence, CacheTransaction, CacheReqOp
-from random import random, randint, choice, sample
+from random import random, randint, randrange, choice, sample
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import os
-import logging
+import cProfile
 import pdb
-logger = logging.getLogger(__name__)
 
 
 class CoherencyError(AssertionError):
@@ -33,10 +41,29 @@ class CacheCoherencyTest:
       target_dir: str,
       check: bool,
       debug: bool,
+      incremental: bool = False,
+      full_check_interval: int = 0,
+      batched_check: bool = False,
+      trace_format: str = "txt",
+      follow: bool = False,
+      poll_interval: float = 1.0,
+      jobs: int = 1,
+      segment_batches: int = 0,
+      checkpoint_interval: int = 0,
+      resume_file: str = None,
+      bisect_interval: int = 0,
+      vectorized_txns: bool = False,
+      log_file: str = "cache_python.log",
+      log_level: str = "info",
+      log_format: str = "text",
+      metrics_file: str = None,
+      profile_file: str = None,
       **kwargs
       ):
 
-    logging.basicConfig(filename='cache_python.log', filemode='w', level=logging.INFO)
+    # Events of the coherency check, see event_log.py. Without a log file
+    # they are kept in memory.
+    self.events = EventLog(log_file, log_level, log_format=log_format)
 
     self.aw = addr_width
     self.dw = data_width
@@ -49,17 +76,69 @@ class CacheCoherencyTest:
     self.target_dir = target_dir
     self.check = check
     self.debug = debug
+    # Only check the cache lines touched since the previous check
+    self.incremental = incremental
+    # In incremental mode, check all lines every N timestamps (0: never)
+    self.full_check_interval = full_check_interval
+    # Check cache lines of all caches at once with array operations
+    self.batched_check = batched_check
+    # Number of cache lines checked at once in batched mode
+    self.check_batch_lines = 4096
+    # Format of the traces to reconstruct from: "txt" or "bin"
+    # (see trace_binary.py)
+    self.trace_format = trace_format
+    # Check while the simulation is running, until it writes the
+    # completion marker (see get_done_marker_file)
+    self.follow = follow
+    # Seconds between polls of the traces in follow mode
+    self.poll_interval = poll_interval
+    # Number of processes for the coherency checks during reconstruction
+    self.jobs = jobs
+    # Check segments of this many timestamps in parallel, starting from
+    # checkpoints taken in a replay-only pass (0: off)
+    self.segment_batches = segment_batches
+    # Save a checkpoint file every N timestamps (0: never)
+    self.checkpoint_interval = checkpoint_interval
+    # Checkpoint file to resume the check from
+    self.resume_file = resume_file
+    # Only search the first failing timestamp, checking every N timestamps
+    # and bisecting the first failing interval (0: off)
+    self.bisect_interval = bisect_interval
+    # Generate the random transactions in chunks with NumPy while writing
+    self.vectorized_txns = vectorized_txns
+    # Write the timers and counters of reconstruct_state to this JSON file
+    self.metrics_file = metrics_file
+    # Profile reconstruct_state with cProfile and dump the stats to this file
+    self.profile_file = profile_file
+    # Timers and counters of the last reconstruct_state
+    self.metrics = Metrics()
 
     self.cacheline_bytes = \
       self.cacheline_words * self.word_width // 8
 
     self.mem_ranges : list[MemoryRange] = []
 
+    # Which caches have outstanding transactions on an address
+    self.outstanding_index = OutstandingIndex()
+
+    # Cacheline addresses touched since the last coherency check
+    self.dirty_lines = set()
+    # Set while a ParallelChecker runs the checks
+    self.parallel_checker = None
+
   @property
   def caches(self) -> List[CacheState]:
     if not hasattr(self, '_caches'):
+      # The arrays of all caches are stacked, so that they can be
+      # checked at once
+      self._cache_arrays = (
+        np.zeros((self.n_caches, self.sets, self.ways), dtype=np.uint8),
+        np.zeros((self.n_caches, self.sets, self.ways), dtype=np.uint64),
+        np.zeros((self.n_caches, self.sets, self.ways, self.cacheline_bytes),
+                 dtype=np.uint8)
+      )
       self._caches = []
-      for _ in range(0, self.n_caches):
+      for i in range(0, self.n_caches):
         cache = CacheState(
             addr_width=self.aw,
             data_width=self.dw,
@@ -68,12 +147,36 @@ class CacheCoherencyTest:
             ways=self.ways,
             sets=self.sets
           )
-        cache.init_cache()
+        cache.init_cache(
+          cache_status=self._cache_arrays[0][i],
+          cache_tag=self._cache_arrays[1][i],
+          cache_data=self._cache_arrays[2][i]
+        )
+        cache.outstanding = OutstandingSet(self.outstanding_index, i)
         self._caches.append(cache)
     return self._caches
   @caches.setter
   def caches(self, caches: List[CacheState]):
     self._caches = caches
+    self._cache_arrays = None
+    self.outstanding_index = OutstandingIndex()
+    for i, cache in enumerate(caches):
+      outstanding = OutstandingSet(self.outstanding_index, i)
+      for addr in cache.outstanding:
+        outstanding.append(addr)
+      cache.outstanding = outstanding
+
+  def get_cache_arrays(self):
+    """Returns the (status, tag, data) arrays of all caches, stacked along
+    a new first axis."""
+    caches = self.caches
+    if self._cache_arrays is not None:
+      return self._cache_arrays
+    return (
+      np.stack([cache.cache_status for cache in caches]),
+      np.stack([cache.cache_tag for cache in caches]),
+      np.stack([cache.cache_data for cache in caches])
+    )
 
   @property
   def mem_state(self) -> MemoryState:
@@ -127,7 +230,10 @@ class CacheCoherencyTest:
 
   def generate_random_transactions(self):
     for txn_seq in self.transactions:
-      txn_seq.generate_rand_sequence(self.n_transactions)
+      if self.vectorized_txns:
+        txn_seq.generate_rand_stream(self.n_transactions)
+      else:
+        txn_seq.generate_rand_sequence(self.n_transactions)
 
   def save_transactions(self):
     for i, txn_seq in enumerate(self.transactions):
@@ -139,9 +245,13 @@ class CacheCoherencyTest:
       file=os.path.join(self.target_dir, "main_mem.mem"))
 
   def save_state(self):
-    self.save_caches()
-    self.save_transactions()
-    self.save_memory()
+    """Write all initial state files. The files are written concurrently."""
+    with ThreadPoolExecutor() as executor:
+      futures = self.submit_save_caches(executor)
+      futures.append(executor.submit(self.save_transactions))
+      futures.append(executor.submit(self.save_memory))
+      for future in futures:
+        future.result()
 
   def rand_choice(self, odds=0.5):
     """Returns true for given odds"""
@@ -173,40 +283,70 @@ class CacheCoherencyTest:
   def get_rand_mem_range(self) -> MemoryRange:
     return choice(self.mem_ranges)
 
+  def get_rand_set_addr(self, mem_range: MemoryRange, set, resident):
+    """Random cacheline address of mem_range in set that is not in
+    resident, or None if there is none."""
+    first_line = -(-mem_range.start_addr // self.cacheline_bytes)
+    end_line = mem_range.end_addr // self.cacheline_bytes
+    # First line of the range in set, and the number of lines in it
+    first_line += (set - first_line) % self.sets
+    n_lines = max(0, (end_line - first_line + self.sets - 1) // self.sets)
+    # At most ways lines per cache of a set are resident, so drawing from
+    # a range with many more lines rarely hits one
+    max_resident = self.n_caches * self.ways
+    if n_lines > 4 * max_resident:
+      while True:
+        addr = (first_line + randrange(n_lines) * self.sets) * \
+          self.cacheline_bytes
+        if addr not in resident:
+          return addr
+    addrs = [
+      (first_line + i * self.sets) * self.cacheline_bytes
+      for i in range(n_lines)
+    ]
+    addrs = [addr for addr in addrs if addr not in resident]
+    if not addrs:
+      return None
+    return choice(addrs)
+
   def generate_random_caches(self, n_inited_lines):
-    for _ in range(n_inited_lines):
-      # Get a random memory range
-      rand_mem_range = self.get_rand_mem_range()
-      # Get a random address from that memory range
-      # Aligned to cache line boundary
-      addr = rand_mem_range.get_rand_addr(self.cacheline_bytes)
+    """Place n_inited_lines random cache lines in random caches, or fewer
+    if the caches or the memory ranges run out of lines.
+    The candidate lines are drawn from the sets that still have a free
+    way in one of the caches."""
+    # Sets with a free way in any cache, per memory range. Full sets and
+    # sets without candidate lines are removed when they are drawn.
+    open_sets = [list(range(self.sets)) for _ in self.mem_ranges]
+    # Lines resident in any cache
+    resident = set().union(*[cache.resident_addrs for cache in self.caches])
+    placed = 0
+    while placed < n_inited_lines:
+      open_ranges = [idx for idx, sets in enumerate(open_sets) if sets]
+      if not open_ranges:
+        break
+      # Get a random memory range, and a random set
+      range_idx = choice(open_ranges)
+      rand_mem_range = self.mem_ranges[range_idx]
+      sets = open_sets[range_idx]
+      set_pos = randrange(len(sets))
+      set_idx = sets[set_pos]
+      free_caches = [
+        idx for idx, cache in enumerate(self.caches) if cache.free_ways[set_idx]]
+      addr = None
+      if free_caches:
+        addr = self.get_rand_set_addr(
+          rand_mem_range, set_idx, resident)
+      if addr is None:
+        sets[set_pos] = sets[-1]
+        sets.pop()
+        continue
       # Get data from initialized memory
       data = rand_mem_range.get_data(addr, self.cacheline_bytes)
 
-      # Check if all caches have space for the new entry
-      # Skip if not
-      not_free_found = False
-      for cache in self.caches:
-        _, free = cache.get_free_way(cache.get_index(addr))
-        if not free:
-          not_free_found = True
-      if not_free_found:
-        continue
-
-      # Check if the address is already stored
-      # Skip if yes
-      hit_found = False
-      for cache in self.caches:
-        hit, _, _, _, _ = cache.get_addr(addr)
-        if hit:
-          hit_found = True
-      if hit_found:
-        continue
-
       # Select random number of masters to have that cache line
-      n_masters = randint(1, self.n_caches)
+      n_masters = randint(1, len(free_caches))
       # Randomly select the master indices to have that cache line
-      mst_idxs = sample(range(self.n_caches), n_masters)
+      mst_idxs = sample(free_caches, n_masters)
       # Select whether someone will hold the line in dirty state
       dirty = self.rand_choice(odds=0.5)
       shared = len(mst_idxs) > 1
@@ -230,225 +370,709 @@ class CacheCoherencyTest:
             state = CachelineState(CachelineStateEnum.SHARED)
           else:
             state = CachelineState(CachelineStateEnum.EXCLUSIVE)
-        try:
-          self.set_cache_line(
-            mst_idx,
-            addr,
-            write_data,
-            state.get_state_bits()
-          )
-        except CacheSetFullException:
-          pass
+        self.set_cache_line(
+          mst_idx,
+          addr,
+          write_data,
+          state.get_state_bits()
+        )
+      resident.add(addr)
+      placed += 1
 
-  def get_next_timestamp(self, files, cur_time):
-    """
-    Returns (finish, next_tstamp, addrs_w_same_tstamp).
-    If finish == True, it means there are no more timestamps\n
-    `addrs_w_same_tstamp` is a list of (idx, addr), which indicates
-    the cache index that retires a transaction on this timestamp, and
-    the address it retires.
-    """
-    # Store:
-    #  - Timestamps that were found
-    #  - Corresponding address
-    #  - Corresponding master index
-    # There might be situations where some masters have run out of
-    # transactions while other ones still have outstanding ones,
-    # so this type of tracking is needed
-    timestamps = []
-    addrs = []
-    idxs = []
-    addrs_w_tstamp = []
-    for i, file in enumerate(files):
-      with open(file, "r") as cache_file:
-        for line in cache_file:
-          words = line.split()
-          time = None
-          initiator = None
-          addr = None
-          # Iterate over words (separated by whitespace)
-          for word in words:
-            # Check which keyword the word is
-            # The keywords must appear in the line in this order
-            t_idx = word.find("TIME:")
-            i_idx = word.find("INITIATOR:")
-            a_idx = word.find("ADDR:")
-            payload = word.split(":")[1]
-            if t_idx != -1:
-              time = int(payload)
-            if i_idx != -1:
-              initiator = bool(int(payload))
-              if not initiator:
-                # Don't store the time of this timestamp marks an
-                # outstanding transaction
-                time = None
-            if a_idx != -1:
-              addr = int(payload, 16)
-          # Add to the list only if a transaction was retired on this
-          # timestamp
-          if time:
-            if time > cur_time:
-              timestamps.append(time)
-              addrs.append(addr)
-              idxs.append(i)
-              break
-    finish = False
-    next_tstamp = 0
-    if all(x == float("inf") for x in timestamps):
-      finish = True
+  def get_cache_trace_files(self, ext="txt"):
+    return [
+      os.path.join(self.target_dir, f"cache_diff_{i}.{ext}")
+      for i in range(self.n_caches)
+    ]
+
+  def get_mem_trace_file(self, ext="txt"):
+    return os.path.join(self.target_dir, f"main_mem_diff.{ext}")
+
+  def get_done_marker_file(self):
+    """File created by the testbench when the simulation finishes."""
+    return os.path.join(self.target_dir, "sim_done")
+
+  def clear_traces(self):
+    """Remove the traces and the completion marker of a previous run."""
+    files = self.get_cache_trace_files() + \
+      [self.get_mem_trace_file(), self.get_done_marker_file()]
+    for file in files:
+      if os.path.exists(file):
+        os.remove(file)
+
+  def open_trace_cursors(self):
+    """Returns the cursors of the cache traces and the main memory trace."""
+    if self.trace_format == "bin":
+      cache_cursors = [
+        BinaryCacheTraceCursor(file)
+        for file in self.get_cache_trace_files("bin")
+      ]
+      mem_cursor = BinaryMemTraceCursor(self.get_mem_trace_file("bin"))
+    elif self.trace_format == "txt":
+      cache_cursors = [
+        CacheTraceCursor(file) for file in self.get_cache_trace_files()
+      ]
+      mem_cursor = MemTraceCursor(self.get_mem_trace_file())
     else:
-      next_tstamp = min(timestamps)
-      idx_w_same_tstamp = [i for i, x in enumerate(timestamps) if x == next_tstamp]
-      for i in idx_w_same_tstamp:
-        addrs_w_tstamp.append((idxs[i], addrs[i]))
-    return finish, next_tstamp, addrs_w_tstamp
+      raise Exception(f"Unknown trace format {self.trace_format}")
+    return cache_cursors, mem_cursor
 
-  def reconstruct_state(self):
-    """Reconstruct state into Python datatypes"""
-    files = []
-    start_time = 0
+  def get_line_addr(self, addr):
+    return addr & ~(self.cacheline_bytes - 1)
+
+  def apply_batch(self, batch: TraceBatch):
+    """Apply the events of a batch to the caches and main memory.
+    The touched cacheline addresses are added to self.dirty_lines.
+    A modified cache entry touches both the line it now holds and the
+    line it held before.
+    """
+    metrics = self.metrics
+    metrics.count("timestamps")
+    for i, cache in enumerate(self.caches):
+      records = batch.cache_records[i]
+      if not records:
+        continue
+      metrics.count("cache_records", len(records))
+      with metrics.phase(f"replay_cache_{i}"):
+        for record in records:
+          self.dirty_lines.add(self.get_line_addr(record.addr))
+          if record.modify:
+            self.dirty_lines.add(cache.get_line_addr(
+              int(cache.cache_tag[record.set, record.way]), record.set))
+            self.dirty_lines.add(cache.get_line_addr(record.tag, record.set))
+          cache.apply_record(record)
+    metrics.count("mem_records",
+                  sum(len(record.data) for record in batch.mem_records))
+    with metrics.phase("replay_mem"):
+      runs = self.mem_state.apply_records(batch.mem_records)
+      for addr, data in runs:
+        for line_addr in range(self.get_line_addr(addr), addr + len(data),
+                               self.cacheline_bytes):
+          self.dirty_lines.add(line_addr)
+    metrics.count("mem_runs", len(runs))
+
+  def get_batches(self, is_done=None):
+    """merge_traces of the trace cursors, timed as the discover phase."""
+    return self.metrics.timed_iter("discover", merge_traces(
+      self.cache_cursors, self.mem_cursor,
+      is_done=is_done, poll_interval=self.poll_interval))
+
+  def get_checkpoint(self, n_batch=0, time=None):
+    """Snapshot of the checker state after n_batch batches were checked.
+    Holds copies of the cache arrays, main memory, outstanding transactions,
+    the lines to check next and the positions of the trace cursors."""
+    status, tag, data = self.get_cache_arrays()
+    return {
+      "n_batch": n_batch,
+      "time": time,
+      "cache_status": np.array(status),
+      "cache_tag": np.array(tag),
+      "cache_data": np.array(data),
+      "mem_data": [r.copy_data() for r in self.mem_ranges],
+      "outstanding": [dict(cache.outstanding.counts) for cache in self.caches],
+      "dirty_lines": sorted(self.dirty_lines),
+      "cache_cursors": [cursor.get_state() for cursor in self.cache_cursors],
+      "mem_cursor": self.mem_cursor.get_state(),
+    }
+
+  def restore_checkpoint(self, checkpoint):
+    """Restore a snapshot taken with get_checkpoint.
+    Reopens the trace cursors at the saved positions."""
+    for i, cache in enumerate(self.caches):
+      cache.cache_status[...] = checkpoint["cache_status"][i]
+      cache.cache_tag[...] = checkpoint["cache_tag"][i]
+      cache.cache_data[...] = checkpoint["cache_data"][i]
+      cache.outstanding.clear()
+      for addr, count in checkpoint["outstanding"][i].items():
+        for _ in range(count):
+          cache.outstanding.append(addr)
+    for mem_range, mem_data in zip(self.mem_ranges, checkpoint["mem_data"]):
+      mem_range.restore_data(mem_data)
+    self.dirty_lines = set(checkpoint["dirty_lines"])
+    self.cache_cursors, self.mem_cursor = self.open_trace_cursors()
+    for cursor, state in zip(self.cache_cursors, checkpoint["cache_cursors"]):
+      cursor.set_state(state)
+    self.mem_cursor.set_state(checkpoint["mem_cursor"])
+
+  def get_checkpoint_file(self, n_batch):
+    return os.path.join(
+      self.target_dir, "checkpoints", f"checkpoint_{n_batch}.npz")
+
+  def save_checkpoint(self, file, checkpoint):
+    """Save a checkpoint from get_checkpoint to a compressed .npz file."""
+    cursor_states = checkpoint["cache_cursors"] + [checkpoint["mem_cursor"]]
+    outstanding = [
+      (i, addr, count)
+      for i, counts in enumerate(checkpoint["outstanding"])
+      for addr, count in counts.items()
+    ]
+    arrays = {
+      "n_batch": np.int64(checkpoint["n_batch"]),
+      "time": np.int64(
+        -1 if checkpoint["time"] is None else checkpoint["time"]),
+      "trace_format": np.array(self.trace_format),
+      "cache_status": checkpoint["cache_status"],
+      "cache_tag": checkpoint["cache_tag"],
+      "cache_data": checkpoint["cache_data"],
+      "mem_addrs": np.array(
+        [(r.start_addr, r.end_addr) for r in self.mem_ranges],
+        dtype=np.uint64).reshape(-1, 2),
+      "outstanding": np.array(outstanding, dtype=np.uint64).reshape(-1, 3),
+      "dirty_lines": np.array(checkpoint["dirty_lines"], dtype=np.uint64),
+      # end_time is None before the first read_until, stored as -1
+      "cursor_states": np.array([
+        (state["offset"], state["time"],
+         -1 if state["end_time"] is None else state["end_time"])
+        for state in cursor_states], dtype=np.int64),
+    }
+    for i, mem_data in enumerate(checkpoint["mem_data"]):
+      if isinstance(mem_data, SparsePages):
+        # The allocated pages only, the others are filled from the seed
+        # again when they are accessed
+        populated = mem_data.get_populated()
+        arrays[f"mem_page_idxs_{i}"] = np.array(
+          [idx for idx, _ in populated], dtype=np.int64)
+        arrays[f"mem_pages_{i}"] = np.array(
+          [page for _, page in populated], dtype=np.uint8).reshape(
+            len(populated), mem_data.page_bytes)
+        arrays[f"mem_page_seed_{i}"] = np.int64(
+          -1 if mem_data.seed is None else mem_data.seed)
+      else:
+        arrays[f"mem_data_{i}"] = mem_data
+    os.makedirs(os.path.dirname(os.path.abspath(file)), exist_ok=True)
+    np.savez_compressed(file, **arrays)
+
+  def load_checkpoint(self, file):
+    """Load a checkpoint saved with save_checkpoint.
+    The geometry of the test and its memory ranges must match."""
+    with np.load(file) as arrays:
+      if arrays["cache_data"].shape != \
+          (self.n_caches, self.sets, self.ways, self.cacheline_bytes):
+        raise Exception(f"Cache geometry of {file} does not match the test")
+      mem_addrs = [
+        (r.start_addr, r.end_addr) for r in self.mem_ranges
+      ]
+      if arrays["mem_addrs"].tolist() != [list(a) for a in mem_addrs]:
+        raise Exception(f"Memory ranges of {file} do not match the test")
+      if str(arrays["trace_format"]) != self.trace_format:
+        raise Exception(
+          f"{file} was saved with {arrays['trace_format']} traces")
+      time = int(arrays["time"])
+      outstanding = [{} for _ in range(self.n_caches)]
+      for i, addr, count in arrays["outstanding"].tolist():
+        outstanding[i][addr] = count
+      cursor_states = [
+        {"offset": offset, "time": time,
+         "end_time": None if end_time == -1 else end_time}
+        for offset, time, end_time in arrays["cursor_states"].tolist()
+      ]
+      return {
+        "n_batch": int(arrays["n_batch"]),
+        "time": None if time == -1 else time,
+        "cache_status": arrays["cache_status"],
+        "cache_tag": arrays["cache_tag"],
+        "cache_data": arrays["cache_data"],
+        "mem_data": [
+          self.load_mem_data(arrays, i, mem_range)
+          for i, mem_range in enumerate(self.mem_ranges)
+        ],
+        "outstanding": outstanding,
+        "dirty_lines": arrays["dirty_lines"].tolist(),
+        "cache_cursors": cursor_states[:-1],
+        "mem_cursor": cursor_states[-1],
+      }
+
+  def load_mem_data(self, arrays, i, mem_range: MemoryRange):
+    """Data of memory range i in the arrays of a checkpoint file."""
+    if not mem_range.sparse:
+      return arrays[f"mem_data_{i}"]
+    seed = int(arrays[f"mem_page_seed_{i}"])
+    pages = SparsePages(
+      mem_range.end_addr - mem_range.start_addr, mem_range.page_bytes,
+      None if seed == -1 else seed)
+    for idx, page in zip(arrays[f"mem_page_idxs_{i}"].tolist(),
+                         arrays[f"mem_pages_{i}"]):
+      pages.pages[idx] = page
+    return pages
+
+  def save_checkpoint_at(self, n_batch, time):
+    """Save a checkpoint file if n_batch is a multiple of
+    checkpoint_interval."""
+    if self.checkpoint_interval and n_batch % self.checkpoint_interval == 0:
+      with self.metrics.phase("checkpoint"):
+        self.save_checkpoint(
+          self.get_checkpoint_file(n_batch), self.get_checkpoint(n_batch, time))
+
+  def retire_batch(self, batch: TraceBatch, log=True):
+    """Clear the outstanding addresses of the other caches for the
+    transactions retired in a batch. The cleared lines are added to
+    self.dirty_lines."""
+    with self.metrics.phase("retire"):
+      for idx, addr in batch.retired:
+        for i in self.outstanding_index.get_holders(addr):
+          if i == idx:
+            continue
+          if self.caches[i].clear_outstanding_addr(addr):
+            if log:
+              self.events.log("outstanding_cleared", addr, i)
+            # The line was skipped while outstanding, check it again
+            self.dirty_lines.add(self.get_line_addr(addr))
+
+  def check_batches(self, batches, start=1):
+    """Apply and check batches, numbered from start."""
     errors = False
-    for i in range(self.n_caches):
-      files.append(os.path.join(self.target_dir, f"cache_diff_{i}.txt"))
-    while True:
-      finish, end_time, addrs = self.get_next_timestamp(files, start_time)
-      if finish:
-        break
-      for i, cache in enumerate(self.caches):
-        cache.reconstruct_state(files[i], start_time, end_time)
-      self.mem_state.reconstruct_mem(os.path.join(self.target_dir, "main_mem_diff.txt"), start_time, end_time)
-      logger.info(f"==================== TIMESTAMP: {end_time} ====================")
-      new_errors = self.check_coherency()
+    for n_batch, batch in enumerate(batches, start=start):
+      self.apply_batch(batch)
+      self.events.log("timestamp", batch.time)
+      full_check = (not self.incremental) or \
+        (self.full_check_interval and
+         n_batch % self.full_check_interval == 0)
+      if full_check:
+        new_errors = self.check_coherency()
+      else:
+        new_errors = self.check_coherency(addrs=self.dirty_lines)
+      self.dirty_lines = set()
       errors = errors or new_errors
-      for addr in addrs:
-        # Clear outstanding addresses for the ones that were handled this timestamp
-        for i in range(self.n_caches):
-          if i == addr[0]:
-            continue
-          if self.caches[i].clear_outstanding_addr(addr[1]):
-            logger.info("Removing address from outstanding")
-            self.print_info(addr=addr[1], cache_idx=i)
-      start_time = end_time
+      self.retire_batch(batch)
+      self.save_checkpoint_at(n_batch, batch.time)
     return errors
 
-  def print_info(self, level=logging.INFO, addr=None, cache_idx=None, state=None,
-                  set=None, way=None):
-    if addr is not None:
-      logger.log(level, msg=f"Address: {hex(addr)}")
-    if cache_idx is not None:
-      logger.log(level, msg=f"Cache: {cache_idx}")
-    if state is not None:
-      logger.log(level, msg=f"State: {state}")
-    if set is not None:
-      logger.log(level, msg=f"Set: {set}")
-    if way is not None:
-      logger.log(level, msg=f"Way: {way}")
-
-  def check_coherency(self):
+  def check_quiet(self):
+    """check_coherency without logs and pdb. Returns True on errors."""
+    debug = self.debug
+    level = self.events.level
+    self.debug = False
+    self.events.level = 0
+    try:
+      return self.check_coherency()
+    finally:
+      self.events.level = level
+      self.debug = debug
+
+  def seek_batch(self, checkpoint, n_batch):
+    """Restore a checkpoint and replay up to batch n_batch without checks.
+    Batch n_batch is applied but its transactions are not retired.
+    Returns the batch, or None if the traces end before it."""
+    self.restore_checkpoint(checkpoint)
+    batches = self.get_batches()
+    for _ in range(n_batch - checkpoint["n_batch"] - 1):
+      batch = next(batches, None)
+      if batch is None:
+        return None
+      self.apply_batch(batch)
+      self.dirty_lines = set()
+      self.retire_batch(batch, log=False)
+    batch = next(batches, None)
+    if batch is not None:
+      self.apply_batch(batch)
+    return batch
+
+  def bisect_state(self, start_batch=0):
+    """Find the first timestamp on which the coherency check fails.
+    The traces are replayed and checked only every bisect_interval
+    timestamps, without logs. The first failing interval is then
+    binary-searched from the checkpoint at its start, so a violation is
+    assumed to persist until the end of its interval. The check of the
+    failing timestamp is logged as usual and the state is left there.
+    Returns True if a failing timestamp was found."""
+    interval = self.bisect_interval
+    good = self.get_checkpoint(start_batch)
+    bad = None
+    n_batch = start_batch
+    for n_batch, batch in enumerate(
+        self.get_batches(), start=start_batch + 1):
+      self.apply_batch(batch)
+      if n_batch % interval == 0 and self.check_quiet():
+        bad = n_batch
+        break
+      self.dirty_lines = set()
+      self.retire_batch(batch, log=False)
+      if n_batch % interval == 0:
+        good = self.get_checkpoint(n_batch, batch.time)
+    if bad is None and n_batch % interval != 0:
+      # The last, partial interval
+      self.seek_batch(good, n_batch)
+      if self.check_quiet():
+        bad = n_batch
+    if bad is None:
+      self.events.log("no_violation")
+      return False
+
+    while bad - good["n_batch"] > 1:
+      mid = (good["n_batch"] + bad) // 2
+      batch = self.seek_batch(good, mid)
+      if self.check_quiet():
+        bad = mid
+      else:
+        self.dirty_lines = set()
+        self.retire_batch(batch, log=False)
+        good = self.get_checkpoint(mid, batch.time)
+    batch = self.seek_batch(good, bad)
+    self.events.log("timestamp", batch.time)
+    self.check_coherency()
+    self.events.log("first_violation", batch.time)
+    return True
+
+  def reconstruct_state(self):
+    """Reconstruct state into Python datatypes.
+    The timers and counters of the run are kept in self.metrics and
+    written to metrics_file, if given."""
+    self.metrics = Metrics()
+    write_time = self.events.write_time
+    n_written = self.events.n_written
+    profiler = None
+    if self.profile_file is not None:
+      profiler = cProfile.Profile()
+      profiler.enable()
+    try:
+      return self.replay_traces()
+    finally:
+      if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(self.profile_file)
+        self.metrics.add_profile(profiler)
+      self.events.flush()
+      # The log is written by its own thread, only its wall time is known
+      log_timer = self.metrics.phase("log")
+      log_timer.wall += self.events.write_time - write_time
+      log_timer.calls += 1
+      self.metrics.count("log_events", self.events.n_written - n_written)
+      if self.metrics_file is not None:
+        self.metrics.save(self.metrics_file)
+
+  def replay_traces(self):
+    """Replay and check the traces, in the mode selected by the
+    parameters. Returns True on errors."""
+    start_batch = 0
+    if self.resume_file is not None:
+      checkpoint = self.load_checkpoint(self.resume_file)
+      self.restore_checkpoint(checkpoint)
+      start_batch = checkpoint["n_batch"]
+      self.events.log("resume", checkpoint["time"])
+    else:
+      self.cache_cursors, self.mem_cursor = self.open_trace_cursors()
+      self.dirty_lines = set()
+    if self.segment_batches and not (self.debug or self.bisect_interval):
+      if self.follow:
+        raise Exception("Segmented checks don't support follow mode")
+      return SegmentedChecker(
+        self, self.jobs, self.segment_batches, self.events).run(start_batch)
+    is_done = None
+    if self.follow:
+      if self.bisect_interval:
+        raise Exception("Bisection doesn't support follow mode")
+      if self.trace_format != "txt":
+        raise Exception("Follow mode only supports text traces")
+      is_done = lambda: os.path.exists(self.get_done_marker_file())
+    batches = self.get_batches(is_done)
+    if self.jobs > 1 and not self.debug:
+      self.parallel_checker = ParallelChecker(self, self.jobs, self.events)
+      self.parallel_checker.start()
+    try:
+      if self.bisect_interval:
+        return self.bisect_state(start_batch)
+      return self.check_batches(batches, start=start_batch + 1)
+    finally:
+      if self.parallel_checker is not None:
+        self.parallel_checker.close()
+        self.parallel_checker = None
+
+  def get_check_addrs(self, mem_range: MemoryRange, addrs=None):
+    """Cacheline addresses of mem_range to check, in ascending order.
+    If addrs is given, only the ones in it are returned. Of a sparse range,
+    only the lines held or outstanding in a cache are checked, since the
+    others can't be incoherent."""
+    if addrs is None and mem_range.sparse:
+      addrs = self.get_cached_lines()
+    if addrs is None:
+      return range(
+        mem_range.start_addr,
+        mem_range.end_addr,
+        self.cacheline_bytes)
+    return sorted(
+      addr for addr in addrs
+      if mem_range.start_addr <= addr < mem_range.end_addr)
+
+  def get_cached_lines(self):
+    """Cacheline addresses valid or outstanding in any cache."""
+    status, tag, _ = self.get_cache_arrays()
+    geometry = self.caches[0]
+    cache_idx, sets, way = np.nonzero((status & VALID_MASK) != 0)
+    lines = (tag[cache_idx, sets, way] <<
+             np.uint64(geometry.block_offset_bits + geometry.index_bits)) | \
+      (sets.astype(np.uint64) << np.uint64(geometry.block_offset_bits))
+    return set(lines.tolist()) | {
+      self.get_line_addr(addr) for addr in self.outstanding_index.addrs()}
+
+  def check_coherency(self, addrs=None):
     """Check that caches and main memory are coherent.
     Test cases:
       - Modified cache line must not be in Exclusive state
       - Modified cache line must have it somewhere in either Owned or Modified state
       - Cache line states must be compatible (e.g. Modified && Shared is not allowed)
+    If addrs is given, only those cacheline addresses are checked.
       """
 
-    logger.info("Starting coherency check")
+    with self.metrics.phase("check"):
+      self.events.log("check_start")
+      error = False
+      if self.parallel_checker is not None:
+        error = self.parallel_checker.check(addrs)
+      else:
+        for mem_range in self.mem_ranges:
+          if self.batched_check:
+            new_error = self.check_range_batched(mem_range, addrs)
+          else:
+            new_error = self.check_range(mem_range, addrs)
+          error = error or new_error
+      self.events.log("check_end")
+    return error
+
+  def check_range(self, mem_range: MemoryRange, addrs=None):
+    """Check the cache lines of one memory range address by address."""
     error = False
     debug = self.debug
+    events = self.events
+    log_hits = events.wants("hit")
+    for addr in self.get_check_addrs(mem_range, addrs):
+      cached, shared = mem_range.get_addr_properties(addr)
+      skip_addr = False
+      if not (shared and cached):
+        # Currently only checking shared and cached regions
+        continue
 
-    for mem_range in self.mem_ranges:
-      for addr in range(
-                mem_range.start_addr,
-                mem_range.end_addr,
-                self.cacheline_bytes):
-        cached, shared = mem_range.get_addr_properties(addr)
-        skip_addr = False
-        if not (shared and cached):
-          # Currently only checking shared and cached regions
-          continue
+      # Check if there are addresses which have outstanding transactions
+      # This occurs when a snoop transaction has modified a cache line, but
+      # the transaction itself didnt finish yet
+      if self.outstanding_index.is_outstanding(addr):
+        skip_addr = True
+        events.log("skip", addr)
+      if skip_addr:
+        self.metrics.count("lines_skipped")
+        continue
+      self.metrics.count("lines_checked")
 
-        # Check if there are addresses which have outstanding transactions
-        # This occurs when a snoop transaction has modified a cache line, but
-        # the transaction itself didnt finish yet
-        for cache in self.caches:
-          if addr in cache.outstanding:
-            skip_addr = True
-            logger.info("Skipping address due to an outstanding transaction")
-            self.print_info(logging.INFO, addr=addr)
-            break
-        if skip_addr:
-          continue
+      cacheline = mem_range.get_data(addr, self.cacheline_bytes)
+      states: List[CachelineState] = []
+      modified = False
+      owner_found = False
 
-        cacheline = mem_range.get_data(addr, self.cacheline_bytes)
-        states: List[CachelineState] = []
-        modified = False
-        owner_found = False
-
-        # Check all caches whether they hold a copy
-        # Compute moesi state
-        # Check that modified copy is not in Exclusive state
-        # Monitor whether a modified copy exists
-        # Monitor whether an owner is found
-        for i, cache in enumerate(self.caches):
-          hit, data, state, set, way = cache.get_addr(addr)
-          moesi: CachelineState = state
-          if hit:
-            logger.info("Cacheline found")
-            self.print_info(logging.INFO, addr=addr, cache_idx=i, state=moesi.state.name, set=set, way=way)
-            if data != cacheline:
-              if moesi.state != CachelineStateEnum.INVALID:
-                modified = True
-              if moesi.state == CachelineStateEnum.EXCLUSIVE:
-                logger.error("A modified cache line in Exclusive state")
-                self.print_info(logging.ERROR, addr=addr, cache_idx=i, state=moesi.state.name, set=set, way=way)
-                error = True
-                if debug: import pdb; pdb.set_trace()
-            if moesi.state in \
-              [CachelineStateEnum.OWNED, CachelineStateEnum.MODIFIED]:
-              owner_found = True
-          states.append(moesi)
-
-        if modified and not owner_found:
-          error = True
-          logger.error("A modified cache line without owner was found!")
-          self.print_info(logging.ERROR, addr=addr, set=set)
-          if debug: import pdb; pdb.set_trace()
-
-        # Compare cacheline states
-        for i in range(len(states)):
-          for j in range(len(states)):
-            if i == j:
-              continue
-            res = states[i].check_compatibility(states[j].state)
-            if not res:
-              a_hit, _, a_state, a_set, a_way = self.caches[i].get_addr(addr)
-              b_hit, _, b_state, b_set, b_way = self.caches[j].get_addr(addr)
-              logger.error("Two cache lines in incompatible states!")
-              self.print_info(
-                logging.ERROR,
-                addr=addr,
-                cache_idx=(i, j),
-                state=(states[i].state.name, states[j].state.name),
-                set=(a_set, b_set),
-                way=(a_way, b_way)
-              )
+      # Check all caches whether they hold a copy
+      # Compute moesi state
+      # Check that modified copy is not in Exclusive state
+      # Monitor whether a modified copy exists
+      # Monitor whether an owner is found
+      for i, cache in enumerate(self.caches):
+        hit, data, state, set, way = cache.get_addr(addr)
+        moesi: CachelineState = state
+        if hit:
+          if log_hits:
+            events.log("hit", addr, i, moesi.state.name, set, way)
+          if not np.array_equal(data, cacheline):
+            if moesi.state != CachelineStateEnum.INVALID:
+              modified = True
+            if moesi.state == CachelineStateEnum.EXCLUSIVE:
+              events.log("exclusive_error", addr, i, moesi.state.name, set, way)
               error = True
-              if debug: import pdb; pdb.set_trace()
-    logger.info("Coherency check finished")
+              self.metrics.count("errors")
+              if debug: events.flush(); pdb.set_trace()
+          if moesi.state in \
+            [CachelineStateEnum.OWNED, CachelineStateEnum.MODIFIED]:
+            owner_found = True
+        states.append(moesi)
+
+      if modified and not owner_found:
+        error = True
+        self.metrics.count("errors")
+        events.log("no_owner_error", addr, set)
+        if debug: events.flush(); pdb.set_trace()
+
+      # Compare cacheline states
+      for i in range(len(states)):
+        for j in range(len(states)):
+          if i == j:
+            continue
+          res = states[i].check_compatibility(states[j].state)
+          if not res:
+            a_hit, _, a_state, a_set, a_way = self.caches[i].get_addr(addr)
+            b_hit, _, b_state, b_set, b_way = self.caches[j].get_addr(addr)
+            events.log(
+              "incompatible_error",
+              addr,
+              (i, j),
+              (states[i].state.name, states[j].state.name),
+              (a_set, b_set),
+              (a_way, b_way)
+            )
+            error = True
+            self.metrics.count("errors")
+            if debug: events.flush(); pdb.set_trace()
     return error
 
-  def save_caches(self):
+  def get_cached_shared_mask(self, mem_range: MemoryRange, lines):
+    """Vectorized get_addr_properties, returns cached & shared."""
+    mask = np.zeros(len(lines), dtype=bool)
+    cached = mem_range.cached_region
+    shared = mem_range.shared_region
+    if cached and shared:
+      mask = (lines >= cached.start_addr) & (lines <= cached.end_addr) & \
+        (lines >= shared.start_addr) & (lines <= shared.end_addr)
+    return mask
+
+  def get_outstanding_addrs(self):
+    """Returns an array of addresses outstanding in any cache."""
+    return np.fromiter(self.outstanding_index.addrs(), dtype=np.uint64)
+
+  def check_range_batched(self, mem_range: MemoryRange, addrs=None):
+    """Batched check_coherency of the cache lines of one memory range.
+    The lines are checked in chunks of self.check_batch_lines."""
+    if addrs is None and not mem_range.sparse:
+      lines = np.arange(
+        mem_range.start_addr,
+        mem_range.end_addr,
+        self.cacheline_bytes,
+        dtype=np.uint64)
+    else:
+      lines = np.array(
+        self.get_check_addrs(mem_range, addrs), dtype=np.uint64)
+    error = False
+    for start in range(0, len(lines), self.check_batch_lines):
+      new_error = self.check_lines_batched(
+        mem_range, lines[start:start + self.check_batch_lines])
+      error = error or new_error
+    return error
+
+  def check_lines_batched(self, mem_range: MemoryRange, lines):
+    """Check an array of cacheline addresses in all caches at once.
+    The tag, status and data arrays of all caches are indexed by the sets of
+    all lines, and the invariants of check_coherency are evaluated with
+    array operations. The state pairs are checked with COMPATIBILITY_LUT.
+    Results are logged in the same order as by the serial check.
+    """
+    debug = self.debug
+    error = False
+    cache_status, cache_tag, cache_data = self.get_cache_arrays()
+    geometry = self.caches[0]
+
+    # Currently only checking shared and cached regions
+    lines = lines[self.get_cached_shared_mask(mem_range, lines)]
+    n_lines = len(lines)
+    if n_lines == 0:
+      return error
+    skipped = np.isin(lines, self.get_outstanding_addrs())
+    n_skipped = int(np.count_nonzero(skipped))
+    self.metrics.count("lines_skipped", n_skipped)
+    self.metrics.count("lines_checked", n_lines - n_skipped)
+
+    sets = ((lines & geometry.index_mask) >>
+            geometry.block_offset_bits).astype(np.intp)
+    tags = (lines & geometry.tag_mask) >> \
+      (geometry.block_offset_bits + geometry.index_bits)
+    # Shape (caches, lines, ways)
+    status = cache_status[:, sets]
+    hit_ways = (cache_tag[:, sets] == tags[None, :, None]) & \
+      ((status & VALID_MASK) != 0)
+    # Shape (caches, lines)
+    hit = hit_ways.any(axis=2) & ~skipped[None, :]
+    # Like get_addr, take the last hitting way, 0 on a miss
+    way = self.ways - 1 - np.argmax(hit_ways[:, :, ::-1], axis=2)
+    way = np.where(hit, way, 0)
+    cache_idx = np.arange(self.n_caches)[:, None]
+    line_idx = np.arange(n_lines)[None, :]
+    states = np.where(
+      hit,
+      STATE_LUT[status[cache_idx, line_idx, way]],
+      CachelineStateEnum.INVALID.value)
+
+    offsets = (lines - mem_range.start_addr).astype(np.intp)
+    mem_lines = mem_range.mem_data[
+      offsets[:, None] + np.arange(self.cacheline_bytes)]
+    data = cache_data[cache_idx, sets[None, :], way]
+    dirty = hit & (data != mem_lines[None]).any(axis=2)
+    exclusive_error = dirty & \
+      (states == CachelineStateEnum.EXCLUSIVE.value)
+    owner_found = (hit & (
+      (states == CachelineStateEnum.OWNED.value) |
+      (states == CachelineStateEnum.MODIFIED.value))).any(axis=0)
+    no_owner_error = dirty.any(axis=0) & ~owner_found
+    # Shape (caches, caches, lines)
+    incompatible = ~COMPATIBILITY_LUT[states[:, None, :], states[None, :, :]]
+    incompatible[np.arange(self.n_caches), np.arange(self.n_caches)] = False
+
+    # Only the lines with events are visited
+    events = self.events
+    log_hits = events.wants("hit")
+    visit = skipped | exclusive_error.any(axis=0) | no_owner_error | \
+      incompatible.any(axis=(0, 1))
+    if log_hits:
+      visit |= hit.any(axis=0)
+    for idx in np.flatnonzero(visit):
+      addr = int(lines[idx])
+      set = int(sets[idx])
+      if skipped[idx]:
+        events.log("skip", addr)
+        continue
+      for i in np.flatnonzero(hit[:, idx]):
+        if not (log_hits or exclusive_error[i, idx]):
+          continue
+        state = CachelineStateEnum(states[i, idx]).name
+        if log_hits:
+          events.log("hit", addr, int(i), state, set, int(way[i, idx]))
+        if exclusive_error[i, idx]:
+          events.log(
+            "exclusive_error", addr, int(i), state, set, int(way[i, idx]))
+          error = True
+          self.metrics.count("errors")
+          if debug: events.flush(); pdb.set_trace()
+      if no_owner_error[idx]:
+        error = True
+        self.metrics.count("errors")
+        events.log("no_owner_error", addr, set)
+        if debug: events.flush(); pdb.set_trace()
+      for i, j in zip(*np.nonzero(incompatible[:, :, idx])):
+        events.log(
+          "incompatible_error",
+          addr,
+          (int(i), int(j)),
+          (CachelineStateEnum(states[i, idx]).name,
+           CachelineStateEnum(states[j, idx]).name),
+          (set, set),
+          (int(way[i, idx]), int(way[j, idx]))
+        )
+        error = True
+        self.metrics.count("errors")
+        if debug: events.flush(); pdb.set_trace()
+    return error
+
+  def submit_save_caches(self, executor):
+    """Submit the writers of all cache files to executor.
+    Returns the futures."""
+    futures = []
     for i, cache in enumerate(self.caches):
-      cache.save_state(
-        data_file=os.path.join(self.target_dir, f"data_mem_{i}.mem"),
-        tag_file=os.path.join(self.target_dir, f"tag_mem_{i}.mem"),
-        state_file=os.path.join(self.target_dir, f"state_{i}.mem")
-      )
+      futures += [
+        executor.submit(cache.save_data,
+          os.path.join(self.target_dir, f"data_mem_{i}.mem")),
+        executor.submit(cache.save_tag,
+          os.path.join(self.target_dir, f"tag_mem_{i}.mem")),
+        executor.submit(cache.save_status,
+          os.path.join(self.target_dir, f"state_{i}.mem"))
+      ]
+    return futures
+
+  def save_caches(self):
+    with ThreadPoolExecutor() as executor:
+      for future in self.submit_save_caches(executor):
+        future.result()
 
   def run(self):
     errors = False
     if self.check:
-      input("Press enter after simulation finishes to start coherency check")
+      if self.follow:
+        self.clear_traces()
+        print("Checking coherency while the simulation runs, "
+              f"until {self.get_done_marker_file()} is created")
+      else:
+        input("Press enter after simulation finishes to start coherency check")
       errors = self.reconstruct_state()
     return errors
 
@@ -472,7 +1096,7 @@ class RandomTest(CacheCoherencyTest):
     self.generate_random_memory()
     self.generate_random_transactions()
     self.generate_random_caches(n_inited_lines=100)
-    self.check_coherency()
+    self.initial_errors = self.check_coherency()
     self.save_state()
 
 class ConflictTest(CacheCoherencyTest):
@@ -577,7 +1201,115 @@ if __name__ == "__main__":
     action='store_true',
     help="Debug mode. During coherency checking, will open pdb when error is encountered."
   )
+  parser.add_argument(
+    '--incremental',
+    action='store_true',
+    help="Only check the cache lines touched since the previous timestamp"
+  )
+  parser.add_argument(
+    '--batched_check',
+    action='store_true',
+    help="Check the cache lines of all caches at once with array operations"
+  )
+  parser.add_argument(
+    '--trace_format',
+    type=str,
+    choices=["txt", "bin"],
+    default="txt",
+    help="Format of the traces used for the coherency check"
+  )
+  parser.add_argument(
+    '--follow',
+    action='store_true',
+    help=("Check while the simulation is running instead of waiting for "
+          "a keypress. Stops once the simulation has finished.")
+  )
+  parser.add_argument(
+    '--poll_interval',
+    type=float,
+    default=1.0,
+    help="Seconds between polls of the traces in follow mode"
+  )
+  parser.add_argument(
+    '--full_check_interval',
+    type=int,
+    default=0,
+    help="In incremental mode, check all cache lines every N timestamps"
+  )
+  parser.add_argument(
+    '--jobs',
+    type=int,
+    default=1,
+    help="Number of processes for the coherency check (ignored with --debug)"
+  )
+  parser.add_argument(
+    '--segment_batches',
+    type=int,
+    default=0,
+    help=("Replay the traces once, taking a checkpoint every N timestamps, "
+          "then check the segments in parallel with --jobs processes")
+  )
+  parser.add_argument(
+    '--checkpoint_interval',
+    type=int,
+    default=0,
+    help=("Save the checker state to TARGET_DIR/checkpoints every N "
+          "timestamps")
+  )
+  parser.add_argument(
+    '--resume_file',
+    type=str,
+    default=None,
+    help="Resume the check from a saved checkpoint"
+  )
+  parser.add_argument(
+    '--bisect_interval',
+    type=int,
+    default=0,
+    help=("Only find the first failing timestamp: check every N timestamps, "
+          "then bisect the first failing interval")
+  )
+  parser.add_argument(
+    '--vectorized_txns',
+    action='store_true',
+    help=("Generate the random transactions with NumPy in one batch per "
+          "master. Faster for long sequences, but draws different "
+          "transactions for the same seed.")
+  )
+  parser.add_argument(
+    '--log_level',
+    type=str,
+    choices=["off", "error", "info", "hits"],
+    default="info",
+    help=("Events written to the log of the check: errors, and by default "
+          "also timestamps, skipped and retired lines; hits adds every "
+          "cache line found")
+  )
+  parser.add_argument(
+    '--log_format',
+    type=str,
+    choices=LOG_FORMATS,
+    default="text",
+    help=("Format of the log of the check: the text view in "
+          "cache_python.log, or JSON lines in cache_python.jsonl, which "
+          "event_log.py queries")
+  )
+  parser.add_argument(
+    '--metrics_file',
+    type=str,
+    default=None,
+    help=("Write the phase timers and event counters of the coherency "
+          "check to this JSON file")
+  )
+  parser.add_argument(
+    '--profile_file',
+    type=str,
+    default=None,
+    help=("Profile the coherency check with cProfile and dump the stats to "
+          "this file")
+  )
   parsed_args = vars(parser.parse_args())
+  parsed_args["log_file"] = LOG_FILES[parsed_args["log_format"]]
   if parsed_args.get("seed", None):
     seed(parsed_args["seed"])
     np.random.seed(parsed_args["seed"])
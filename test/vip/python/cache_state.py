@@ -1,12 +1,28 @@
 from typing import List, Tuple
 from math import log2
 from enum import Enum
+import numpy as np
+from common import HEX_CHARS
+from trace_reader import CacheRecord, CacheTraceCursor
 
 class StateBits(Enum):
   VALID_IDX = 0
   SHARED_IDX = 1
   DIRTY_IDX = 2
 
+def pack_status(state_bits: List[bool]) -> int:
+  """Pack a list of state bits (indexed by StateBits) into an integer."""
+  packed = 0
+  for idx, bit in enumerate(state_bits):
+    if bit:
+      packed |= 1 << idx
+  return packed
+
+def unpack_status(packed: int) -> List[bool]:
+  return [bool((packed >> idx.value) & 1) for idx in StateBits]
+
+VALID_MASK = 1 << StateBits.VALID_IDX.value
+
 class CachelineStateEnum(Enum):
   MODIFIED = 0
   OWNED = 1
@@ -73,6 +89,103 @@ class CachelineState:
     else:
       raise Exception("Unexpected state")
 
+def get_state_lut():
+  """Returns an array mapping packed state bits to CachelineStateEnum values."""
+  lut = np.zeros(1 << len(StateBits), dtype=np.uint8)
+  for packed in range(len(lut)):
+    state = CachelineState()
+    state.from_state_bits(unpack_status(packed))
+    lut[packed] = state.state.value
+  return lut
+
+def get_compatibility_lut():
+  """Returns a boolean array, where [a, b] tells whether CachelineStateEnum
+  values a and b are compatible."""
+  n_states = len(CachelineStateEnum)
+  lut = np.zeros((n_states, n_states), dtype=bool)
+  for a in CachelineStateEnum:
+    for b in CachelineStateEnum:
+      lut[a.value, b.value] = CachelineState(a).check_compatibility(b)
+  return lut
+
+STATE_LUT = get_state_lut()
+COMPATIBILITY_LUT = get_compatibility_lut()
+# CachelineStateEnum of every packed status
+STATE_ENUMS = [CachelineStateEnum(value) for value in STATE_LUT.tolist()]
+
+class OutstandingIndex:
+  """Index of which caches hold outstanding entries for an address.
+  Shared by the OutstandingSet of several caches."""
+  def __init__(self):
+    # address -> set of cache indices
+    self.holders = {}
+
+  def add(self, addr, cache_idx):
+    self.holders.setdefault(addr, set()).add(cache_idx)
+
+  def discard(self, addr, cache_idx):
+    holders = self.holders.get(addr)
+    if holders is None:
+      return
+    holders.discard(cache_idx)
+    if not holders:
+      del self.holders[addr]
+
+  def is_outstanding(self, addr):
+    return addr in self.holders
+
+  def get_holders(self, addr):
+    """Indices of the caches with addr outstanding, in ascending order."""
+    return sorted(self.holders.get(addr, ()))
+
+  def addrs(self):
+    return self.holders.keys()
+
+class OutstandingSet:
+  """Multiset of outstanding addresses (address -> pending count).
+  Behaves like the list it replaces: an address appended twice stays
+  outstanding until it was removed twice.
+  If an index is given, the addresses are also registered in it.
+  """
+  def __init__(self, index: OutstandingIndex = None, cache_idx=None):
+    self.counts = {}
+    self.index = index
+    self.cache_idx = cache_idx
+
+  def append(self, addr):
+    count = self.counts.get(addr, 0)
+    self.counts[addr] = count + 1
+    if count == 0 and self.index is not None:
+      self.index.add(addr, self.cache_idx)
+
+  def remove(self, addr):
+    """Remove one occurrence of addr. Raises ValueError if not present."""
+    count = self.counts.get(addr, 0)
+    if count == 0:
+      raise ValueError(f"{addr} is not outstanding")
+    if count == 1:
+      del self.counts[addr]
+      if self.index is not None:
+        self.index.discard(addr, self.cache_idx)
+    else:
+      self.counts[addr] = count - 1
+
+  def clear(self):
+    for addr in list(self.counts):
+      while addr in self.counts:
+        self.remove(addr)
+
+  def __contains__(self, addr):
+    return addr in self.counts
+
+  def __iter__(self):
+    for addr, count in self.counts.items():
+      for _ in range(count):
+        yield addr
+
+  def __len__(self):
+    return sum(self.counts.values())
+
 class CacheSetFullException(Exception):
   pass
 
@@ -104,30 +217,51 @@ class CacheState:
     self.index_mask = ((1 << self.index_bits) - 1) << self.block_offset_bits
     self.tag_mask = ((1 << self.tag_bits) - 1) << (self.block_offset_bits + self.index_bits)
 
+    # Packed state bits (see pack_status), shape (sets, ways)
     self.cache_status = None
+    # Cacheline data, shape (sets, ways, cacheline_bytes)
     self.cache_data   = None
+    # Tags, shape (sets, ways)
     self.cache_tag    = None
+    # Number of free (non-valid) ways per set, and the cacheline addresses
+    # of the valid entries. Kept up to date by set_entry only, the trace
+    # replay does not maintain them.
+    self.free_ways = []
+    self.resident_addrs = set()
 
     # Store which cache lines are "outstanding"
     # i.e. a snoop has modified their status, but the
     # respective transaction has not finished
-    self.outstanding = []
-
-  def init_cache(self):
-    # multi-dimensional lists must be initialized in steps
-    # to ensure that unique copies are created, instead of
-    # references to one
-    self.cache_status = self.sets * [None]
-    self.cache_tag = self.sets * [None]
-    self.cache_data = self.sets * [None]
-    for set in range(self.sets):
-      self.cache_status[set] = self.ways * [None]
-      self.cache_tag[set] = self.ways * [None]
-      self.cache_data[set] = self.ways * [None]
-      for way in range(self.ways):
-        self.cache_status[set][way] = 3 * [False]
-        self.cache_tag[set][way] = 0
-        self.cache_data[set][way] = self.cacheline_bytes * [0]
+    self.outstanding = OutstandingSet()
+
+    # Open trace files used by reconstruct_state
+    self.cursors = {}
+
+  def init_cache(self, cache_status=None, cache_tag=None, cache_data=None):
+    """Allocate empty cache arrays.
+    Preallocated (e.g. views of arrays shared by several caches) arrays
+    can be passed instead; they are used as they are."""
+    if cache_status is None:
+      cache_status = np.zeros((self.sets, self.ways), dtype=np.uint8)
+    if cache_tag is None:
+      cache_tag = np.zeros((self.sets, self.ways), dtype=np.uint64)
+    if cache_data is None:
+      cache_data = np.zeros(
+        (self.sets, self.ways, self.cacheline_bytes), dtype=np.uint8)
+    self.cache_status = cache_status
+    self.cache_tag = cache_tag
+    self.cache_data = cache_data
+    self.count_occupancy()
+
+  def count_occupancy(self):
+    """Recompute free_ways and resident_addrs from the cache arrays."""
+    valid = (self.cache_status & VALID_MASK) != 0
+    self.free_ways = (self.ways - valid.sum(axis=1)).tolist()
+    self.resident_addrs = {
+      self.get_line_addr(tag, set)
+      for set, tag in zip(np.nonzero(valid)[0].tolist(),
+                          self.cache_tag[valid].tolist())
+    }
 
   def get_index(self, addr):
     return (addr & self.index_mask) >> self.block_offset_bits
@@ -135,33 +269,33 @@ class CacheState:
   def get_tag(self, addr):
     return (addr & self.tag_mask) >> (self.block_offset_bits + self.index_bits)
 
+  def get_line_addr(self, tag, set):
+    """Returns the cacheline address of a tag stored in a set."""
+    return (tag << (self.block_offset_bits + self.index_bits)) | \
+      (set << self.block_offset_bits)
+
   def get_addr(self, addr):
-    """Returns: (hit, data, state, set, way)"""
+    """Returns: (hit, data, state, set, way)
+    On a hit, data is a view of the cacheline in self.cache_data.
+    Looks at the ways one by one, which is faster than array operations
+    for a single set; see CacheCoherencyTest.check_range_batched for the
+    lookup of many lines at once."""
     set = self.get_index(addr)
-    hit = False
-    final_way = 0
-    data = []
-    state = CachelineState()
-    tag_bits = self.get_tag(addr)
-    for way in range(self.ways):
-      if ((self.cache_tag[set][way] == tag_bits) and
-          (self.cache_status[set][way][StateBits.VALID_IDX.value])):
-        hit = self.cache_status[set][way][StateBits.VALID_IDX.value]
-        data = self.cache_data[set][way]
-        state.from_state_bits(self.cache_status[set][way])
-        final_way = way
-    return hit, data, state, set, final_way
+    tag = self.get_tag(addr)
+    tags = self.cache_tag[set].tolist()
+    status = self.cache_status[set].tolist()
+    for way in range(self.ways - 1, -1, -1):
+      if tags[way] == tag and status[way] & VALID_MASK:
+        state = CachelineState(STATE_ENUMS[status[way]])
+        return True, self.cache_data[set, way], state, set, way
+    return False, [], CachelineState(), set, 0
 
   def get_free_way(self, set):
     """Get first free (non-valid) way in a set."""
-    was_free = False
-    way_idx = 0
-    for i, way in enumerate(self.cache_status[set]):
-      if not way[StateBits.VALID_IDX.value]:
-        way_idx = i
-        was_free = True
-        break
-    return way_idx, was_free
+    for way, status in enumerate(self.cache_status[set].tolist()):
+      if not status & VALID_MASK:
+        return way, True
+    return 0, False
 
   def set_entry(
       self,
@@ -170,69 +304,74 @@ class CacheState:
       status: List[bool]
     ):
     """Write cacheline corresponding to addr with data and status.
-    Assumes we write the whole cache line byte-by-byte
+    Assumes we write the whole cache line
     """
     set_idx = self.get_index(addr)
-    way_idx, was_free = self.get_free_way(set_idx)
-    if not was_free:
+    if not self.free_ways[set_idx]:
       raise CacheSetFullException
-    for byte_idx in range(self.cacheline_bytes):
-      self.cache_data[set_idx][way_idx][byte_idx] = \
-        data[byte_idx]
-    self.cache_tag[set_idx][way_idx] = self.get_tag(addr)
-    self.cache_status[set_idx][way_idx][0] = status[0]
-    self.cache_status[set_idx][way_idx][1] = status[1]
-    self.cache_status[set_idx][way_idx][2] = status[2]
+    way_idx, _ = self.get_free_way(set_idx)
+    tag = self.get_tag(addr)
+    self.cache_data[set_idx, way_idx] = data
+    self.cache_tag[set_idx, way_idx] = tag
+    self.cache_status[set_idx, way_idx] = pack_status(status)
+    if status[StateBits.VALID_IDX.value]:
+      self.free_ways[set_idx] -= 1
+      self.resident_addrs.add(self.get_line_addr(tag, set_idx))
+
+  def get_valid_sets(self):
+    """Indices of the sets with at least one valid way."""
+    return np.flatnonzero(
+      ((self.cache_status & VALID_MASK) != 0).any(axis=1))
+
+  def write_sets(self, file, valid_sets, lines):
+    """Write one "@set line" row per valid set."""
+    with open(file, "wb") as mem_file:
+      mem_file.write(b"".join(
+        f"@{set:x}".encode() + line
+        for set, line in zip(valid_sets.tolist(), lines)
+      ))
 
   def save_data(
     self,
     file
   ):
-    with open(file, "w") as data_file:
-      for set in range(self.sets):
-        fmt = [f"@{set:x}"]
-        any_valid = False
-        for way in range(self.ways):
-          if (self.cache_status[set][way][StateBits.VALID_IDX.value]):
-            any_valid = True
-          for byte in self.cache_data[set][way]:
-            fmt += [f"{byte:2x}"]
-        if any_valid:
-          data_file.write(" ".join(fmt) + "\n")
+    valid_sets = self.get_valid_sets()
+    data = self.cache_data[valid_sets].reshape(
+      len(valid_sets), self.ways * self.cacheline_bytes)
+    # " xx" per byte, and a newline after the last one
+    chars = np.empty(data.shape + (3,), dtype=np.uint8)
+    chars[:, :, 0] = ord(" ")
+    chars[:, :, 1:] = HEX_CHARS[data]
+    row_bytes = chars.shape[1] * 3
+    body = chars.tobytes()
+    self.write_sets(file, valid_sets, [
+      body[i * row_bytes:(i + 1) * row_bytes] + b"\n"
+      for i in range(len(valid_sets))
+    ])
 
   def save_tag(
     self,
     file
   ):
-    with open(file, "w") as tag_file:
-      for set in range(self.sets):
-        fmt = [f"@{set:x}"]
-        any_valid = False
-        for way in range(self.ways):
-          if (self.cache_status[set][way][StateBits.VALID_IDX.value]):
-            any_valid = True
-          fmt += [f"{self.cache_tag[set][way]:2x}"]
-        if any_valid:
-          tag_file.write(" ".join(fmt) + "\n")
+    valid_sets = self.get_valid_sets()
+    self.write_sets(file, valid_sets, [
+      "".join(f" {tag:2x}" for tag in tags).encode() + b"\n"
+      for tags in self.cache_tag[valid_sets].tolist()
+    ])
 
   def status_arr_to_int(self, bool_arr):
-    bin_str = ''.join(['1' if x else '0' for x in list(reversed(bool_arr))])
-    return int(bin_str, 2)
+    return pack_status(bool_arr)
 
   def save_status(
     self,
     file
   ):
-    with open(file, "w") as state_file:
-      for set in range(self.sets):
-        fmt = [f"@{set:x}"]
-        any_valid = False
-        for way in range(self.ways):
-          if (self.cache_status[set][way][StateBits.VALID_IDX.value]):
-            any_valid = True
-          fmt += [f"{self.status_arr_to_int(self.cache_status[set][way]):03b}"]
-        if any_valid:
-          state_file.write(" ".join(fmt) + "\n")
+    status_str = [f" {packed:03b}" for packed in range(8)]
+    valid_sets = self.get_valid_sets()
+    self.write_sets(file, valid_sets, [
+      "".join(status_str[packed] for packed in row).encode() + b"\n"
+      for row in self.cache_status[valid_sets].tolist()
+    ])
 
   def save_state(
       self,
@@ -254,66 +393,37 @@ class CacheState:
     except ValueError:
       return False
 
+  def apply_record(self, record: CacheRecord):
+    """Apply a single cache trace record to the state."""
+    if record.modify:
+      self.cache_data[record.set, record.way] = np.frombuffer(
+        record.data, dtype=np.uint8)
+      self.cache_tag[record.set, record.way] = record.tag
+      self.cache_status[record.set, record.way] = pack_status(record.status)
+    if not record.initiator:
+      self.outstanding.append(record.addr)
+
   def reconstruct_state(
       self,
       file,
       start_time,
       end_time
   ):
-    with open(file, "r") as state_file:
-      for line in state_file:
-        words = line.split()
-        addr = None
-        time = None
-        initiator = None
-        set = None
-        way = None
-        tag = None
-        status = None
-        data = None
-        modify = True
-        for word in words:
-          time_idx = word.find("TIME:")
-          initiator_idx = word.find("INITIATOR:")
-          addr_idx = word.find("ADDR:")
-          set_idx = word.find("SET:")
-          way_idx = word.find("WAY")
-          tag_idx = word.find("TAG:")
-          status_idx = word.find("STATUS:")
-          data_idx = word.find("DATA:")
-          payload = word.split(":")[1]
-          if time_idx != -1:
-            time = int(payload)
-          if addr_idx != -1:
-            addr = int(payload, 16)
-          if set_idx != -1:
-            set = int(payload)
-          if initiator_idx != -1:
-            initiator = bool(int(payload))
-          if way_idx != -1:
-            way = int(payload)
-          if tag_idx != -1:
-            tag = int(payload, 16)
-          if status_idx != -1:
-            status = [char == '1' for char in payload]
-            status.reverse()
-          if data_idx != -1:
-            data = [int(x, 16) for x in payload.strip("[]").split(",")]
-        if None in [time,initiator,set,way,tag,status,data]:
-          # A row with only time and address present indicates
-          # a finished transaction which wasn't cached but might've
-          # modified other cache lines by snooping
-          if None in [time, addr]:
-            print("Unexpected state")
-            import pdb; pdb.set_trace()
-          modify = False
-        if time > end_time:
-          return time
-        if time <= start_time:
-          continue
-        if modify:
-          self.cache_data[set][way] = data
-          self.cache_tag[set][way] = tag
-          self.cache_status[set][way] = status
-        if not initiator:
-          self.outstanding.append(addr)
+    """Apply the records with start_time < time <= end_time.
+    The file position is remembered, so a call with start_time equal to
+    the end_time of the previous call only parses new lines.
+    Returns the first timestamp after end_time, or None at the end of
+    the file.
+    """
+    if file not in self.cursors:
+      self.cursors[file] = CacheTraceCursor(file)
+    cursor = self.cursors[file]
+    if (cursor.end_time is not None) and (start_time < cursor.end_time):
+      cursor.rewind()
+    for record in cursor.read_until(end_time):
+      if record.time <= start_time:
+        continue
+      self.apply_record(record)
+    next_record = cursor.peek()
+    if next_record is not None:
+      return next_record.time
@@ -2,6 +2,151 @@ import numpy as np
 from random import randrange
 from typing import List
 
+# "{:2x}" of every byte value, shape (256, 2)
+HEX_CHARS = np.frombuffer(
+  "".join(f"{byte:2x}" for byte in range(256)).encode(),
+  dtype=np.uint8).reshape(256, 2)
+
+def format_hex_bytes(data, sep=" ", end="\n"):
+  """Vectorized formatting of a 2D byte array.
+  Every row becomes one line of "{:2x}" formatted bytes separated by sep
+  and terminated by end. Returns the lines as one bytes object."""
+  data = np.asarray(data, dtype=np.uint8)
+  rows, cols = data.shape
+  chars = np.empty((rows, cols, 3), dtype=np.uint8)
+  chars[:, :, :2] = HEX_CHARS[data]
+  chars[:, :, 2] = ord(sep)
+  chars[:, -1, 2] = ord(end)
+  return chars.tobytes()
+
+# Digits of base 10 and base 16 numbers
+DIGIT_CHARS = np.frombuffer(b"0123456789abcdef", dtype=np.uint8)
+
+def format_uints(values, base=10, width=1):
+  """Vectorized f"{value:0{width}}" (base 10) or f"{value:0{width}x}"
+  (base 16) of a uint64 array.
+  Returns a 2D array with the characters of one number per row. Leading
+  positions that are not part of a number are 0, so the rows of a line
+  can be concatenated and the 0 bytes dropped."""
+  values = np.asarray(values, dtype=np.uint64)
+  n_digits = width
+  if len(values):
+    n_digits = max(width, len(np.base_repr(int(values.max()), base)))
+  digits = np.empty((len(values), n_digits), dtype=np.uint8)
+  for pos in range(n_digits - 1, -1, -1):
+    digits[:, pos] = values % np.uint64(base)
+    values = values // np.uint64(base)
+  keep = np.logical_or.accumulate(digits != 0, axis=1)
+  keep[:, n_digits - width:] = True
+  chars = DIGIT_CHARS[digits]
+  chars[~keep] = 0
+  return chars
+
+class SparsePages:
+  """Byte array of size bytes, stored in pages of page_bytes that are
+  allocated on first access.
+  Without a seed, new pages are zero. With a seed, a page is filled with
+  random bytes drawn from (seed, page index), so its contents do not
+  depend on the order in which the pages are touched.
+  Supports the indexing the memory ranges are used with: reads of an
+  index, a slice or an array of indices, and writes of an index or a
+  slice. Reads of a slice within a page return a view.
+  """
+  def __init__(self, size, page_bytes=1 << 12, seed=None):
+    if page_bytes & (page_bytes - 1):
+      raise Exception("The page size must be a power of 2")
+    self.size = size
+    self.page_bytes = page_bytes
+    self.page_bits = page_bytes.bit_length() - 1
+    self.seed = seed
+    # Page index -> array of page_bytes
+    self.pages = {}
+
+  @property
+  def shape(self):
+    return (self.size,)
+
+  def __len__(self):
+    return self.size
+
+  def get_page(self, page_idx):
+    page = self.pages.get(page_idx)
+    if page is None:
+      if self.seed is None:
+        page = np.zeros(self.page_bytes, dtype=np.uint8)
+      else:
+        page = np.random.default_rng((self.seed, page_idx)).integers(
+          0, 256, size=self.page_bytes, dtype=np.uint8)
+      self.pages[page_idx] = page
+    return page
+
+  def get_populated(self):
+    """(page index, page) of the allocated pages, in address order."""
+    return sorted(self.pages.items())
+
+  def get_slice(self, key):
+    start, stop, step = key.indices(self.size)
+    if step != 1:
+      raise Exception("Slices of sparse memory must be contiguous")
+    if stop <= start:
+      return np.zeros(0, dtype=np.uint8)
+    first_page = start >> self.page_bits
+    last_page = (stop - 1) >> self.page_bits
+    offset = start - (first_page << self.page_bits)
+    if first_page == last_page:
+      return self.get_page(first_page)[offset:offset + stop - start]
+    data = np.concatenate(
+      [self.get_page(idx) for idx in range(first_page, last_page + 1)])
+    return data[offset:offset + stop - start]
+
+  def __getitem__(self, key):
+    if isinstance(key, slice):
+      return self.get_slice(key)
+    if key is Ellipsis:
+      return self.get_slice(slice(None))
+    if isinstance(key, (int, np.integer)):
+      return self.get_page(int(key) >> self.page_bits)[
+        int(key) & (self.page_bytes - 1)]
+    indices = np.asarray(key).astype(np.int64)
+    page_idxs, inverse = np.unique(
+      indices >> self.page_bits, return_inverse=True)
+    table = np.stack([self.get_page(int(idx)) for idx in page_idxs])
+    return table[
+      inverse.reshape(indices.shape), indices & (self.page_bytes - 1)]
+
+  def __setitem__(self, key, value):
+    if isinstance(key, (int, np.integer)):
+      self.get_page(int(key) >> self.page_bits)[
+        int(key) & (self.page_bytes - 1)] = value
+      return
+    if key is Ellipsis:
+      key = slice(None)
+    start, stop, step = key.indices(self.size)
+    if step != 1:
+      raise Exception("Slices of sparse memory must be contiguous")
+    value = np.broadcast_to(np.asarray(value, dtype=np.uint8),
+                            (max(stop - start, 0),))
+    pos = start
+    while pos < stop:
+      page_idx = pos >> self.page_bits
+      offset = pos & (self.page_bytes - 1)
+      n_bytes = min(self.page_bytes - offset, stop - pos)
+      self.get_page(page_idx)[offset:offset + n_bytes] = \
+        value[pos - start:pos - start + n_bytes]
+      pos += n_bytes
+
+  def __array__(self, dtype=None, copy=None):
+    """Dense copy, allocating all pages. Only meant for small ranges."""
+    data = self.get_slice(slice(None))
+    if dtype is not None:
+      data = data.astype(dtype)
+    return data
+
+  def copy(self):
+    pages = SparsePages(self.size, self.page_bytes, self.seed)
+    pages.pages = {idx: page.copy() for idx, page in self.pages.items()}
+    return pages
+
 class MemoryRange:
   def __init__(
       self,
@@ -9,6 +154,9 @@ class MemoryRange:
       end_addr: int,
       cached: bool = False,
       shared: bool = False,
+      backing_file: str = None,
+      sparse: bool = False,
+      page_bytes: int = 1 << 12,
   ):
     """
     Parameters
@@ -17,7 +165,13 @@ class MemoryRange:
       end_addr End address.\n
       cached Set whole range as cached.\n
       shared Set whole range as shared.\n
+      backing_file Keep the data in this file through np.memmap instead of
+      in RAM.\n
+      sparse Keep the data in pages of page_bytes, which are allocated when
+      they are first accessed (see SparsePages).\n
     """
+    if sparse and backing_file is not None:
+      raise Exception("A memory range can't be both sparse and file-backed")
 
     # Start address of the range (inclusive)
     self.start_addr = start_addr
@@ -25,6 +179,11 @@ class MemoryRange:
     self.end_addr = end_addr
     # Data
     self.mem_data = []
+    # File backing mem_data, if any
+    self.backing_file = backing_file
+    # Keep mem_data in lazily allocated pages
+    self.sparse = sparse
+    self.page_bytes = page_bytes
     # Subrange that is cached
     self.cached_region: MemoryRange = None
     # Subrange that is shared
@@ -35,15 +194,53 @@ class MemoryRange:
     if shared:
       self.set_shared_region(start_addr, end_addr)
 
-  def init_random_mem(self):
-    self.mem_data = np.random.randint(
-      0, 256, size=(self.end_addr-self.start_addr),
-      dtype=np.uint8)
+  def alloc_mem(self, mode="w+"):
+    """Allocate zeroed data, or map the backing file.
+    Use mode "r+" to map the existing contents of the backing file."""
+    size = self.end_addr - self.start_addr
+    if self.sparse:
+      self.mem_data = SparsePages(size, self.page_bytes)
+    elif self.backing_file is None:
+      self.mem_data = np.zeros(size, dtype=np.uint8)
+    else:
+      self.mem_data = np.memmap(
+        self.backing_file, dtype=np.uint8, mode=mode, shape=(size,))
+
+  def init_random_mem(self, chunk_bytes=1 << 26):
+    """Fill the range with random data.
+    The data is generated in chunks, so that a file-backed range is never
+    materialized in RAM. The pages of a sparse range are filled when they
+    are allocated."""
+    size = self.end_addr - self.start_addr
+    if self.sparse:
+      self.mem_data = SparsePages(
+        size, self.page_bytes, seed=np.random.randint(1 << 31))
+      return
+    if self.backing_file is None:
+      self.mem_data = np.random.randint(
+        0, 256, size=size,
+        dtype=np.uint8)
+      return
+    self.alloc_mem()
+    for start in range(0, size, chunk_bytes):
+      end = min(start + chunk_bytes, size)
+      self.mem_data[start:end] = np.random.randint(
+        0, 256, size=(end - start), dtype=np.uint8)
 
   def init_zero_mem(self):
-    self.mem_data = np.zeros(
-      size=(self.end_addr-self.start_addr),
-      dtype=np.uint8)
+    self.alloc_mem()
+
+  def copy_data(self):
+    """Copy of mem_data, to be restored with restore_data."""
+    if self.sparse:
+      return self.mem_data.copy()
+    return np.array(self.mem_data)
+
+  def restore_data(self, mem_data):
+    if self.sparse:
+      self.mem_data = mem_data.copy()
+    else:
+      self.mem_data[...] = mem_data
 
   def set_cached_region(self, start_addr, end_addr):
     self.cached_region = MemoryRange(
@@ -87,7 +284,8 @@ class MemoryRange:
       self.shared_region.end_addr,
       step) 
 
-  def get_rand_cached_shared_addr(self, step):
+  def get_cached_shared_bounds(self):
+    """Returns (start, end) of the region that is both cached and shared."""
     if (not self.cached_region) or (not self.shared_region):
       raise Exception("Either cached or shared region is missing")
     if (self.cached_region.start_addr <=
@@ -102,15 +300,22 @@ class MemoryRange:
       end_addr = self.cached_region.end_addr
     if end_addr < start_addr:
       raise Exception("No overlapping shared and cached regions")
+    return start_addr, end_addr
+
+  def get_rand_cached_shared_addr(self, step):
+    start_addr, end_addr = self.get_cached_shared_bounds()
     return randrange(start_addr, end_addr, step)
 
+  def get_rand_cached_shared_addrs(self, step, n, rng=np.random):
+    """n random addresses like get_rand_cached_shared_addr, drawn from
+    rng (np.random or a RandomState). Returns a uint64 array."""
+    start_addr, end_addr = self.get_cached_shared_bounds()
+    n_addrs = len(range(start_addr, end_addr, step))
+    return np.uint64(start_addr) + np.uint64(step) * \
+      rng.randint(0, n_addrs, size=n).astype(np.uint64)
+
   def get_data(self, addr, len):
-    """Return an array of length len, consisting of bytes"""
-    data = []
+    """Return len bytes starting at addr.
+    The result is a view of mem_data, no data is copied."""
     start_idx = addr - self.start_addr
-    end_idx = start_idx + len
-    for i in range(start_idx, end_idx):
-      data.append(self.mem_data[i])
-    return data
-      
-
+    return self.mem_data[start_idx:start_idx + len]
@@ -0,0 +1,306 @@
+from threading import Thread
+from queue import Queue
+from time import perf_counter
+import atexit
+import json
+
+# Verbosity levels, an event is logged if its level is at most the one of
+# the log
+LEVELS = {
+  "off": 0,
+  "error": 1,
+  "info": 2,
+  "hits": 3,
+}
+
+# Event kind: (level, field names). The fields follow the kind in the
+# event tuples and become the keys of the JSON objects.
+EVENTS = {
+  "timestamp": (LEVELS["info"], ("time",)),
+  "check_start": (LEVELS["info"], ()),
+  "check_end": (LEVELS["info"], ()),
+  "skip": (LEVELS["info"], ("addr",)),
+  "hit": (LEVELS["hits"], ("addr", "cache", "state", "set", "way")),
+  "exclusive_error":
+    (LEVELS["error"], ("addr", "cache", "state", "set", "way")),
+  "no_owner_error": (LEVELS["error"], ("addr", "set")),
+  "incompatible_error":
+    (LEVELS["error"], ("addr", "cache", "state", "set", "way")),
+  "outstanding_cleared": (LEVELS["info"], ("addr", "cache")),
+  "resume": (LEVELS["info"], ("time",)),
+  "no_violation": (LEVELS["info"], ()),
+  "first_violation": (LEVELS["info"], ("time",)),
+}
+EVENT_LEVELS = {kind: level for kind, (level, _) in EVENTS.items()}
+ERROR_EVENTS = [
+  kind for kind, level in EVENT_LEVELS.items() if level == LEVELS["error"]]
+
+# Headline of an event in the text view, followed by its fields
+TEXT_HEADLINES = {
+  "check_start": "Starting coherency check",
+  "check_end": "Coherency check finished",
+  "skip": "Skipping address due to an outstanding transaction",
+  "hit": "Cacheline found",
+  "exclusive_error": "A modified cache line in Exclusive state",
+  "no_owner_error": "A modified cache line without owner was found!",
+  "incompatible_error": "Two cache lines in incompatible states!",
+  "outstanding_cleared": "Removing address from outstanding",
+  "no_violation": "No coherency violation found",
+}
+
+
+# Formats of the log file: the text view of the former cache_python.log,
+# or JSON lines
+LOG_FORMATS = ["text", "jsonl"]
+# Default log file of the check for every format
+LOG_FILES = {"text": "cache_python.log", "jsonl": "cache_python.jsonl"}
+
+
+class EventLog:
+  """Structured log of the coherency check.
+  Events are tuples of a kind (see EVENTS) and its fields. They are
+  collected in chunks of chunk_events, which a writer thread formats and
+  appends to file, as JSON lines or in the text view (log_format).
+  Events above the level of the log are dropped; callers check wants(kind)
+  before building costly events.
+  Without a file, the events are kept in memory until taken with take,
+  e.g. to send them from a worker process to the main process.
+  """
+  def __init__(self, file=None, level="info", chunk_events=4096,
+               log_format="jsonl"):
+    self.level = LEVELS[level]
+    if log_format not in LOG_FORMATS:
+      raise Exception(f"Unknown log format {log_format}")
+    self.format_event = \
+      format_event if log_format == "jsonl" else format_text_event
+    self.chunk_events = chunk_events
+    self.events = []
+    # Wall time spent by the writer thread, and the events written
+    self.write_time = 0.0
+    self.n_written = 0
+    self.file = None
+    self.queue = None
+    self.writer = None
+    if file is not None:
+      self.file = open(file, "w")
+      # Bounded, so that a slow disk throttles the check instead of
+      # filling the memory
+      self.queue = Queue(maxsize=16)
+      self.writer = Thread(target=self.write_chunks, daemon=True)
+      self.writer.start()
+      atexit.register(self.close)
+
+  def wants(self, kind):
+    return EVENT_LEVELS[kind] <= self.level
+
+  def log(self, kind, *fields):
+    if EVENT_LEVELS[kind] > self.level:
+      return
+    self.events.append((kind,) + fields)
+    if self.queue is not None and len(self.events) >= self.chunk_events:
+      self.queue.put(self.events)
+      self.events = []
+
+  def extend(self, events):
+    """Log events taken from another EventLog."""
+    self.events += [
+      event for event in events if EVENT_LEVELS[event[0]] <= self.level]
+    if self.queue is not None and len(self.events) >= self.chunk_events:
+      self.queue.put(self.events)
+      self.events = []
+
+  def take(self):
+    """Returns and forgets the events not handed to the writer yet."""
+    events = self.events
+    self.events = []
+    return events
+
+  def write_chunks(self):
+    while True:
+      events = self.queue.get()
+      if events is not None:
+        start = perf_counter()
+        self.file.write("".join(map(self.format_event, events)))
+        self.write_time += perf_counter() - start
+        self.n_written += len(events)
+      self.queue.task_done()
+      if events is None:
+        return
+
+  def flush(self):
+    """Write all logged events to the file."""
+    if self.queue is None:
+      return
+    if self.events:
+      self.queue.put(self.take())
+    self.queue.join()
+    self.file.flush()
+
+  def close(self):
+    if self.queue is None:
+      return
+    self.flush()
+    self.queue.put(None)
+    self.writer.join()
+    self.file.close()
+    self.queue = None
+    atexit.unregister(self.close)
+
+
+def get_event_dict(event):
+  """An event tuple as a dict, keyed like the JSON objects of the log."""
+  names = EVENTS[event[0]][1]
+  record = {"event": event[0]}
+  record.update(zip(names, event[1:]))
+  return record
+
+
+def format_event(event):
+  return json.dumps(get_event_dict(event)) + "\n"
+
+
+def format_text_event(event):
+  return "\n".join(render_event(get_event_dict(event))) + "\n"
+
+
+def read_events(file):
+  """Iterate the events of a log file as dicts."""
+  with open(file) as log_file:
+    for line in log_file:
+      yield json.loads(line)
+
+
+def render_event(event, name="cache_coherency_test"):
+  """Lines of the text view of an event, as the check logged them before
+  the structured log."""
+  kind = event["event"]
+  level = "ERROR" if EVENT_LEVELS[kind] == LEVELS["error"] else "INFO"
+  prefix = f"{level}:{name}:"
+  if kind == "timestamp":
+    return [f"{prefix}==================== TIMESTAMP: {event['time']} "
+            "===================="]
+  if kind == "resume":
+    return [f"{prefix}Resuming after TIMESTAMP: {event['time']}"]
+  if kind == "first_violation":
+    return [f"{prefix}First coherency violation at TIMESTAMP: "
+            f"{event['time']}"]
+  lines = [prefix + TEXT_HEADLINES[kind]]
+  for key, label in [("addr", "Address"), ("cache", "Cache"),
+                     ("state", "State"), ("set", "Set"), ("way", "Way")]:
+    if key not in event:
+      continue
+    value = event[key]
+    if key == "addr":
+      value = hex(value)
+    elif isinstance(value, list):
+      value = tuple(value)
+    lines.append(f"{prefix}{label}: {value}")
+  return lines
+
+
+def query_events(events, kinds=None, addr=None, cache=None, start_time=None,
+                 end_time=None):
+  """Filter events. Every matching event is preceded by the timestamp
+  event it belongs to, once per timestamp."""
+  filters = [kinds, addr, cache, start_time, end_time]
+  if all(value is None for value in filters):
+    yield from events
+    return
+  time = None
+  time_event = None
+  for event in events:
+    kind = event["event"]
+    if kind == "timestamp":
+      time = event["time"]
+      time_event = event
+      continue
+    if start_time is not None and (time is None or time < start_time):
+      continue
+    if end_time is not None and time is not None and time > end_time:
+      continue
+    if kinds is not None and kind not in kinds:
+      continue
+    if addr is not None and event.get("addr") != addr:
+      continue
+    if cache is not None:
+      caches = event.get("cache")
+      if not (caches == cache or
+              (isinstance(caches, list) and cache in caches)):
+        continue
+    if time_event is not None:
+      yield time_event
+      time_event = None
+    yield event
+
+
+if __name__ == "__main__":
+  import argparse
+  import sys
+  parser = argparse.ArgumentParser(
+    description=('Query the event log of a coherency check, and print it '
+                 'in the text view or as JSON lines')
+  )
+  parser.add_argument(
+    'log_file',
+    type=str,
+    help='Event log written by the check (cache_python.jsonl)'
+  )
+  parser.add_argument(
+    '--event',
+    type=str,
+    nargs='+',
+    choices=list(EVENTS),
+    default=None,
+    help='Only print events of these kinds'
+  )
+  parser.add_argument(
+    '--errors',
+    action='store_true',
+    help='Only print errors'
+  )
+  parser.add_argument(
+    '--addr',
+    type=lambda addr: int(addr, 0),
+    default=None,
+    help='Only print events of this cacheline address'
+  )
+  parser.add_argument(
+    '--cache',
+    type=int,
+    default=None,
+    help='Only print events of this cache'
+  )
+  parser.add_argument(
+    '--start_time',
+    type=int,
+    default=None,
+    help='Only print events from this timestamp on'
+  )
+  parser.add_argument(
+    '--end_time',
+    type=int,
+    default=None,
+    help='Only print events up to this timestamp'
+  )
+  parser.add_argument(
+    '--json',
+    action='store_true',
+    help='Print the events as JSON lines instead of the text view'
+  )
+  args = parser.parse_args()
+
+  kinds = args.event
+  if args.errors:
+    kinds = [kind for kind in (kinds or ERROR_EVENTS) if kind in ERROR_EVENTS]
+  events = query_events(
+    read_events(args.log_file), kinds, args.addr, args.cache,
+    args.start_time, args.end_time)
+  try:
+    for event in events:
+      if args.json:
+        sys.stdout.write(json.dumps(event) + "\n")
+      else:
+        sys.stdout.write("\n".join(render_event(event)) + "\n")
+  except BrokenPipeError:
+    # Piped into head and the like
+    sys.stderr.close()
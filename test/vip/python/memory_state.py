@@ -1,5 +1,7 @@
-from common import MemoryRange
-from typing import List
+from common import MemoryRange, format_hex_bytes
+from trace_reader import MemRecord, MemTraceCursor, coalesce_mem_records
+from typing import Iterable, List
+from bisect import bisect_right
 import pdb
 
 class MemoryState:
@@ -8,19 +10,65 @@ class MemoryState:
       mem_ranges: List[MemoryRange] = []
     ):
     self.mem_ranges: List[MemoryRange] = mem_ranges
+    # Open trace files used by reconstruct_mem
+    self.cursors = {}
+    # Start addresses of the ranges in ascending order, and the ranges,
+    # see get_range
+    self.range_starts = []
+    self.sorted_ranges = []
+
+  def get_range(self, addr) -> MemoryRange:
+    """Memory range holding addr, or None."""
+    if len(self.sorted_ranges) != len(self.mem_ranges):
+      self.sorted_ranges = sorted(
+        self.mem_ranges, key=lambda mem_range: mem_range.start_addr)
+      self.range_starts = [
+        mem_range.start_addr for mem_range in self.sorted_ranges]
+    idx = bisect_right(self.range_starts, addr) - 1
+    if idx >= 0 and addr < self.sorted_ranges[idx].end_addr:
+      return self.sorted_ranges[idx]
+    return None
 
   def gen_rand_mem(self):
     for mem_range in self.mem_ranges:
       mem_range.init_random_mem()
 
   def store(self, addr, data):
-    range_found = False
-    for mem_range in self.mem_ranges:
-      if mem_range.start_addr <= addr <= mem_range.end_addr:
-        range_found = True
-        mem_range.mem_data[addr - mem_range.start_addr] = data
-    if not range_found:
+    mem_range = self.get_range(addr)
+    if mem_range is None:
       raise Exception("Provided an address outside the memory range(s)")
+    mem_range.mem_data[addr - mem_range.start_addr] = data
+
+  def store_block(self, addr, data):
+    """Store a bytes-like object from addr on, with one slice assignment
+    per memory range."""
+    data = memoryview(data).cast("B")
+    while True:
+      mem_range = self.get_range(addr)
+      if mem_range is None:
+        raise Exception("Provided an address outside the memory range(s)")
+      offset = addr - mem_range.start_addr
+      n_bytes = mem_range.end_addr - addr
+      if len(data) <= n_bytes:
+        mem_range.mem_data[offset:offset + len(data)] = data
+        return
+      mem_range.mem_data[offset:offset + n_bytes] = data[:n_bytes]
+      addr += n_bytes
+      data = data[n_bytes:]
+
+  def apply_record(self, record: MemRecord):
+    self.store_block(record.addr, record.data)
+
+  def apply_records(self, records: Iterable[MemRecord]):
+    """Apply records in order, merged into runs of consecutive bytes.
+    Returns the (addr, data) runs."""
+    runs = coalesce_mem_records(records)
+    for addr, data in runs:
+      if len(data) == 1:
+        self.store(addr, data[0])
+      else:
+        self.store_block(addr, data)
+    return runs
 
   def reconstruct_mem(
       self,
@@ -29,49 +77,55 @@ class MemoryState:
       end_time
   ) -> int:
     """
-    Updates memory given the transactions in a file.
+    Updates memory given the transactions in a file, applying the writes
+    with start_time < time <= end_time.
     Returns the time stamp that was the first one that was not updated.
+    The file position is remembered, so a call with start_time equal to
+    the end_time of the previous call only parses new lines.
     """
-    with open(file, "r") as mem_file:
-      for line in mem_file:
-        words = line.split()
-        time = -1
-        addr = None
-        data = None
-        for word in words:
-          t_idx = word.find("TIME:")
-          a_idx = word.find("ADDR:")
-          d_idx = word.find("DATA:")
-          payload = word.split(":")[1]
-          if t_idx != -1:
-            time = int(payload)
-          if a_idx != -1:
-            addr = int(payload, 16)
-          if d_idx != -1:
-            data = int(payload, 16)
-        if time > end_time:
-          return time
-        if (time < start_time) and time != -1:
-          continue
-        if (addr is not None) and (data is not None):
-          self.store(addr, data)
-        elif (addr is not None) or (data is not None):
-          raise Exception(
-            "Either data or addr provided without the other"
-          )
+    if file not in self.cursors:
+      self.cursors[file] = MemTraceCursor(file)
+    cursor = self.cursors[file]
+    if (cursor.end_time is not None) and (start_time < cursor.end_time):
+      cursor.rewind()
+    self.apply_records(
+      record for record in cursor.read_until(end_time)
+      if record.time > start_time)
+    next_record = cursor.peek()
+    if next_record is not None:
+      return next_record.time
 
   def save_mem(
     self,
     file="main_mem.mem",
+    chunk_bytes=1 << 24
     ):
-    with open(file, "w") as mem_file:
-      mem_file.write("@0\n")
+    """Write the memory in $readmemh format, four bytes per line.
+    The data is formatted in chunks of chunk_bytes. Of sparse ranges, only
+    the allocated pages are written. An "@addr" line is written wherever
+    the data does not continue at the previous address."""
+    with open(file, "wb") as mem_file:
+      mem_file.write(b"@0\n")
+      next_addr = 0
       for mem_range in self.mem_ranges:
-        for addr in range(mem_range.start_addr, mem_range.end_addr, 4):
-          fmt = "{:2x} {:2x} {:2x} {:2x}\n".format(
-            mem_range.mem_data[addr - mem_range.start_addr],
-            mem_range.mem_data[addr - mem_range.start_addr + 1],
-            mem_range.mem_data[addr - mem_range.start_addr + 2],
-            mem_range.mem_data[addr - mem_range.start_addr + 3]
-          )
-          mem_file.write(fmt)
+        size = mem_range.end_addr - mem_range.start_addr
+        if size % 4:
+          raise Exception("Memory range size must be a multiple of 4 bytes")
+        if mem_range.sparse:
+          pages = mem_range.mem_data
+          blocks = [
+            (idx * pages.page_bytes, page)
+            for idx, page in pages.get_populated()
+          ]
+        else:
+          blocks = [
+            (start, mem_range.mem_data[start:start + chunk_bytes])
+            for start in range(0, size, chunk_bytes)
+          ]
+        for start, data in blocks:
+          data = data[:size - start]
+          addr = mem_range.start_addr + start
+          if addr != next_addr:
+            mem_file.write(f"@{addr:x}\n".encode())
+          mem_file.write(format_hex_bytes(data.reshape(-1, 4)))
+          next_addr = addr + len(data)
@@ -0,0 +1,138 @@
+from time import perf_counter, process_time
+import pstats
+import json
+import os
+
+
+class PhaseTimer:
+  """Accumulated wall and CPU time of one phase.
+  Used as a context manager around every execution of the phase."""
+  __slots__ = ("wall", "cpu", "calls", "wall_start", "cpu_start")
+
+  def __init__(self):
+    self.wall = 0.0
+    self.cpu = 0.0
+    self.calls = 0
+    self.wall_start = 0.0
+    self.cpu_start = 0.0
+
+  def __enter__(self):
+    self.wall_start = perf_counter()
+    self.cpu_start = process_time()
+    return self
+
+  def __exit__(self, *exc_info):
+    self.wall += perf_counter() - self.wall_start
+    self.cpu += process_time() - self.cpu_start
+    self.calls += 1
+
+
+class Metrics:
+  """Phase timers and event counters of a coherency check.
+  Phases of CacheCoherencyTest.reconstruct_state:
+    discover  merging the traces into timestamps, including parsing
+    replay_cache_<i>  applying the records of cache i
+    replay_mem  applying the main memory writes
+    check  coherency checks, including logging their events
+    log  formatting and writing the events, on the writer thread of the
+      event log (wall time only)
+    retire  clearing outstanding transactions
+    checkpoint  taking and saving checkpoints
+  Phases and counters of worker processes are added to the ones of the
+  main process, so with several jobs the phase times can exceed the total
+  wall time.
+  """
+  def __init__(self):
+    self.phases = {}
+    self.counters = {}
+    self.wall_start = perf_counter()
+    self.cpu_start = process_time()
+    # Summary of a cProfile run, see add_profile
+    self.profile = None
+
+  def phase(self, name) -> PhaseTimer:
+    timer = self.phases.get(name)
+    if timer is None:
+      timer = self.phases[name] = PhaseTimer()
+    return timer
+
+  def count(self, name, n=1):
+    self.counters[name] = self.counters.get(name, 0) + n
+
+  def timed_iter(self, name, iterable):
+    """Yield the items of iterable, timing the production of each one as
+    phase name."""
+    timer = self.phase(name)
+    iterator = iter(iterable)
+    while True:
+      with timer:
+        item = next(iterator, None)
+      if item is None:
+        return
+      yield item
+
+  def get_state(self):
+    """Picklable phases and counters, to be merged with merge."""
+    return {
+      "phases": {
+        name: (timer.wall, timer.cpu, timer.calls)
+        for name, timer in self.phases.items()
+      },
+      "counters": dict(self.counters),
+    }
+
+  def merge(self, state):
+    """Add the phases and counters of another Metrics.get_state."""
+    for name, (wall, cpu, calls) in state["phases"].items():
+      timer = self.phase(name)
+      timer.wall += wall
+      timer.cpu += cpu
+      timer.calls += calls
+    for name, n in state["counters"].items():
+      self.count(name, n)
+
+  def add_profile(self, profiler, n_functions=20):
+    """Keep the functions with the largest cumulative time of a disabled
+    cProfile.Profile."""
+    stats = pstats.Stats(profiler)
+    rows = []
+    for (file, line, function), (_, calls, tottime, cumtime, _) in \
+        stats.stats.items():
+      rows.append({
+        "function": f"{os.path.basename(file)}:{line}({function})",
+        "calls": calls,
+        "tottime": tottime,
+        "cumtime": cumtime,
+      })
+    rows.sort(key=lambda row: row["cumtime"], reverse=True)
+    self.profile = rows[:n_functions]
+
+  def get_report(self):
+    wall_time = perf_counter() - self.wall_start
+    cpu_time = process_time() - self.cpu_start
+    records = self.counters.get("cache_records", 0) + \
+      self.counters.get("mem_records", 0)
+    report = {
+      "wall_time": wall_time,
+      "cpu_time": cpu_time,
+      "phases": {
+        name: {"wall": timer.wall, "cpu": timer.cpu, "calls": timer.calls}
+        for name, timer in sorted(self.phases.items())
+      },
+      "counters": dict(sorted(self.counters.items())),
+      "throughput": {
+        "records_per_s": records / wall_time,
+        "timestamps_per_s": self.counters.get("timestamps", 0) / wall_time,
+        "lines_checked_per_s":
+          self.counters.get("lines_checked", 0) / wall_time,
+      },
+    }
+    if self.profile is not None:
+      report["profile"] = self.profile
+    return report
+
+  def save(self, file):
+    """Write the report as JSON."""
+    with open(file, "w") as metrics_file:
+      json.dump(self.get_report(), metrics_file, indent=2)
+      metrics_file.write("\n")
@@ -0,0 +1,467 @@
+from cache_coherency_test import RandomTest
+from cache_state import StateBits
+from transactions import CacheReqOp, ReadSnoopType
+from heapq import merge
+from random import seed
+import numpy as np
+import tempfile
+import time
+import os
+
+VALID = 1 << StateBits.VALID_IDX.value
+SHARED = 1 << StateBits.SHARED_IDX.value
+DIRTY = 1 << StateBits.DIRTY_IDX.value
+
+# Snoops sent by the interconnect to the other caches, see
+# ace_ar_transaction_decoder.sv and ace_aw_transaction_decoder.sv
+SNOOP_READ_SHARED = ReadSnoopType.READSHARED
+SNOOP_READ_UNIQUE = ReadSnoopType.READUNIQUE
+SNOOP_CLEAN_INVALID = ReadSnoopType.CLEANINVALID
+SNOOP_MAKE_INVALID = ReadSnoopType.MAKEINVALID
+
+STORE = CacheReqOp.REQ_STORE.name
+
+
+def read_txns_file(file, cache_idx):
+  """Iterate the transactions of a txns_*.txt file as
+  (time, index, cache_idx, op, addr, data, cached) tuples. data holds the
+  bytes of the word, least significant byte first, like the sequencer
+  sends them."""
+  with open(file) as txns_file:
+    for index, line in enumerate(txns_file):
+      words = line.split()
+      if not words:
+        continue
+      yield (int(words[6][5:]), index, cache_idx, words[0][5:],
+             int(words[1][5:], 16), bytes.fromhex(words[2][5:])[::-1],
+             words[4][5:] == "1")
+
+
+class MoesiModel:
+  """Transaction-level model of the cached masters, the interconnect and
+  main memory.
+  Executes cache transactions like cache_scoreboard.svh does, on a copy of
+  the cache and memory state of a CacheCoherencyTest:
+    - A load hit reads the cache. A cached miss writes back a dirty victim
+      (WriteBack) and allocates the line with ReadShared (load) or
+      ReadUnique (store).
+    - A cached store hit on a shared line first makes it unique
+      (CleanUnique).
+    - An uncached store hit writes the whole line to memory and evicts it
+      (WriteLineUnique). An uncached store miss writes the word to memory
+      (WriteUnique).
+  The other caches are snooped like the interconnect does: ReadShared and
+  ReadUnique with the same snoop, CleanUnique and WriteUnique with
+  CleanInvalid, WriteLineUnique with MakeInvalid. Dirty data that the
+  initiator does not accept is written back to main memory. Victims are
+  chosen with the LRU ranks of the scoreboard.
+  The state is kept in Python lists and bytearrays, and written back to
+  the test with apply. The masters run concurrently in a simulation, so
+  the model executes the transactions in order of their TIME field and
+  otherwise interleaves the masters one transaction at a time.
+  """
+  def __init__(self, test):
+    geometry = test.caches[0]
+    self.n_caches = test.n_caches
+    self.sets = test.sets
+    self.ways = test.ways
+    self.cacheline_bytes = test.cacheline_bytes
+    self.offset_bits = geometry.block_offset_bits
+    self.index_bits = geometry.index_bits
+    self.set_mask = test.sets - 1
+
+    status, tag, data = test.get_cache_arrays()
+    # Entries are indexed by set * ways + way
+    self.status = [cache.ravel().tolist() for cache in status]
+    self.tags = [cache.ravel().tolist() for cache in tag]
+    self.data = [bytearray(cache.tobytes()) for cache in data]
+    # LRU ranks, all 0 after reset like in the scoreboard
+    self.lru = [[0] * (self.sets * self.ways) for _ in range(self.n_caches)]
+    # Cacheline number (address >> offset_bits) -> entry of the valid lines
+    self.lines = []
+    for i in range(self.n_caches):
+      lines = {}
+      for entry in range(self.sets * self.ways):
+        if self.status[i][entry] & VALID:
+          lines[self.get_entry_line(i, entry)] = entry
+      self.lines.append(lines)
+    self.mem_ranges = [
+      (mem_range.start_addr, mem_range.end_addr,
+       bytearray(np.asarray(mem_range.mem_data).tobytes()))
+      for mem_range in test.mem_ranges
+    ]
+    self.counters = {}
+
+  def count(self, name):
+    self.counters[name] = self.counters.get(name, 0) + 1
+
+  def get_entry_line(self, cache_idx, entry):
+    return (self.tags[cache_idx][entry] << self.index_bits) | \
+      (entry // self.ways)
+
+  def get_mem(self, addr):
+    """Returns (bytearray, offset) of addr in main memory."""
+    for start_addr, end_addr, mem_data in self.mem_ranges:
+      if start_addr <= addr < end_addr:
+        return mem_data, addr - start_addr
+    raise Exception(f"Address {hex(addr)} outside the memory range(s)")
+
+  def mem_write(self, addr, data):
+    mem_data, offset = self.get_mem(addr)
+    mem_data[offset:offset + len(data)] = data
+
+  def mem_read(self, addr, n_bytes):
+    mem_data, offset = self.get_mem(addr)
+    return mem_data[offset:offset + n_bytes]
+
+  def get_line_data(self, cache_idx, entry):
+    start = entry * self.cacheline_bytes
+    return self.data[cache_idx][start:start + self.cacheline_bytes]
+
+  def set_status(self, cache_idx, entry, status, line=None):
+    """Set the status of an entry, and its cacheline number if given."""
+    lines = self.lines[cache_idx]
+    if self.status[cache_idx][entry] & VALID:
+      old_line = self.get_entry_line(cache_idx, entry)
+      if lines.get(old_line) == entry:
+        del lines[old_line]
+    if line is not None:
+      self.tags[cache_idx][entry] = line >> self.index_bits
+    else:
+      line = self.get_entry_line(cache_idx, entry)
+    self.status[cache_idx][entry] = status
+    if status & VALID:
+      lines[line] = entry
+
+  def update_lru(self, cache_idx, entry):
+    lru = self.lru[cache_idx]
+    base = entry - entry % self.ways
+    for idx in range(base, base + self.ways):
+      if idx == entry:
+        lru[idx] = self.ways - 1
+      elif lru[idx]:
+        lru[idx] -= 1
+
+  def lookup(self, cache_idx, line):
+    """Returns (hit, entry) like read_and_compare_tag: the entry holding
+    the line, or else the last invalid way, or else the last way with LRU
+    rank 0."""
+    entry = self.lines[cache_idx].get(line)
+    if entry is not None:
+      return True, entry
+    base = (line & self.set_mask) * self.ways
+    status = self.status[cache_idx]
+    lru = self.lru[cache_idx]
+    way = base
+    invalid_found = False
+    for idx in range(base, base + self.ways):
+      if not status[idx] & VALID:
+        way = idx
+        invalid_found = True
+      elif not invalid_found and lru[idx] == 0:
+        way = idx
+    return False, way
+
+  def snoop(self, initiator, line, snoop_op):
+    """Snoop the line in all caches but the initiator.
+    Returns (data, is_shared, pass_dirty) of the combined responses; data
+    is None if no cache transferred any."""
+    data = None
+    is_shared = False
+    pass_dirty = False
+    for i in range(self.n_caches):
+      if i == initiator:
+        continue
+      entry = self.lines[i].get(line)
+      if entry is None:
+        continue
+      self.count(f"snoop_{snoop_op.name.lower()}")
+      status = self.status[i][entry]
+      dirty = bool(status & DIRTY)
+      if snoop_op == SNOOP_READ_SHARED:
+        data = self.get_line_data(i, entry)
+        is_shared = True
+        pass_dirty = pass_dirty or dirty
+        status = (status | SHARED) & ~DIRTY
+      elif snoop_op == SNOOP_READ_UNIQUE:
+        data = self.get_line_data(i, entry)
+        pass_dirty = pass_dirty or dirty
+        status &= ~VALID
+      elif snoop_op == SNOOP_CLEAN_INVALID:
+        if dirty:
+          data = self.get_line_data(i, entry)
+          pass_dirty = True
+        status &= ~VALID
+      else:
+        status &= ~VALID
+      self.set_status(i, entry, status)
+      self.update_lru(i, entry)
+    return data, is_shared, pass_dirty
+
+  def write_back_snooped(self, line, data, pass_dirty):
+    """Write dirty snooped data that the initiator does not accept to
+    main memory."""
+    if pass_dirty and data is not None:
+      self.mem_write(line << self.offset_bits, data)
+
+  def allocate(self, cache_idx, line, entry, snoop_op):
+    """Fill an entry with a line, writing back its dirty victim."""
+    status = self.status[cache_idx][entry]
+    if (status & VALID) and (status & DIRTY):
+      self.count("WRITEBACK")
+      self.mem_write(
+        self.get_entry_line(cache_idx, entry) << self.offset_bits,
+        self.get_line_data(cache_idx, entry))
+    self.count(snoop_op.name)
+    data, is_shared, pass_dirty = self.snoop(cache_idx, line, snoop_op)
+    if data is None:
+      data = self.mem_read(line << self.offset_bits, self.cacheline_bytes)
+    start = entry * self.cacheline_bytes
+    self.data[cache_idx][start:start + self.cacheline_bytes] = data
+    status = VALID
+    if is_shared:
+      status |= SHARED
+    if pass_dirty:
+      status |= DIRTY
+    self.set_status(cache_idx, entry, status, line)
+
+  def write_word(self, cache_idx, entry, addr, data):
+    start = entry * self.cacheline_bytes + \
+      (addr & (self.cacheline_bytes - 1))
+    self.data[cache_idx][start:start + len(data)] = data
+
+  def execute(self, cache_idx, op, addr, data, cached):
+    """Execute one transaction of a master."""
+    line = addr >> self.offset_bits
+    hit, entry = self.lookup(cache_idx, line)
+    if op != STORE:
+      if hit:
+        self.count("load_hit")
+      else:
+        self.count("load_miss")
+        self.allocate(cache_idx, line, entry, SNOOP_READ_SHARED)
+      self.update_lru(cache_idx, entry)
+      return
+
+    if hit:
+      self.count("store_hit")
+      status = self.status[cache_idx][entry]
+      if cached and status & SHARED:
+        self.count("CLEANUNIQUE")
+        snoop_data, _, pass_dirty = self.snoop(
+          cache_idx, line, SNOOP_CLEAN_INVALID)
+        self.write_back_snooped(line, snoop_data, pass_dirty)
+        status = VALID
+      self.write_word(cache_idx, entry, addr, data)
+      if cached:
+        self.set_status(cache_idx, entry, status | DIRTY)
+      else:
+        self.count("WRITELINEUNIQUE")
+        self.snoop(cache_idx, line, SNOOP_MAKE_INVALID)
+        self.mem_write(
+          line << self.offset_bits, self.get_line_data(cache_idx, entry))
+        self.set_status(cache_idx, entry, status & ~VALID)
+      self.update_lru(cache_idx, entry)
+    elif cached:
+      self.count("store_miss")
+      self.allocate(cache_idx, line, entry, SNOOP_READ_UNIQUE)
+      self.write_word(cache_idx, entry, addr, data)
+      self.set_status(cache_idx, entry, self.status[cache_idx][entry] | DIRTY)
+      self.update_lru(cache_idx, entry)
+    else:
+      self.count("store_miss")
+      self.count("WRITEUNIQUE")
+      snoop_data, _, pass_dirty = self.snoop(
+        cache_idx, line, SNOOP_CLEAN_INVALID)
+      self.write_back_snooped(line, snoop_data, pass_dirty)
+      self.mem_write(addr, data)
+
+  def run(self, txns_files):
+    """Execute the transactions of txns_files, one file per master.
+    Returns the number of transactions executed."""
+    n_txns = 0
+    execute = self.execute
+    for _, _, cache_idx, op, addr, data, cached in merge(*[
+        read_txns_file(file, i) for i, file in enumerate(txns_files)]):
+      execute(cache_idx, op, addr, data, cached)
+      n_txns += 1
+    return n_txns
+
+  def get_arrays(self):
+    """Returns the (status, tag, data) arrays of all caches, shaped like
+    CacheCoherencyTest.get_cache_arrays."""
+    shape = (self.n_caches, self.sets, self.ways)
+    return (
+      np.array(self.status, dtype=np.uint8).reshape(shape),
+      np.array(self.tags, dtype=np.uint64).reshape(shape),
+      np.frombuffer(b"".join(self.data), dtype=np.uint8).reshape(
+        shape + (self.cacheline_bytes,)),
+    )
+
+  def apply(self, test):
+    """Write the state of the model to the caches and memory of test."""
+    for array, model_array in zip(test.get_cache_arrays(), self.get_arrays()):
+      array[...] = model_array
+    for mem_range, (_, _, mem_data) in zip(test.mem_ranges, self.mem_ranges):
+      mem_range.mem_data[...] = np.frombuffer(mem_data, dtype=np.uint8)
+
+  def compare(self, test):
+    """Compare the state of the model with the one of test, e.g. after
+    reconstruct_state. The data and tags of invalid entries are ignored.
+    Returns a list of differences."""
+    diffs = []
+    status, tag, data = self.get_arrays()
+    test_status, test_tag, test_data = test.get_cache_arrays()
+    valid = (status & VALID) != 0
+    differs = (status != test_status) | \
+      (valid & ((tag != test_tag) | (data != test_data).any(axis=3)))
+    for i, set, way in zip(*np.nonzero(differs)):
+      diffs.append(
+        f"Cache {i} set {set} way {way}: model status {status[i, set, way]:03b} "
+        f"tag {int(tag[i, set, way]):x}, test status "
+        f"{test_status[i, set, way]:03b} tag {int(test_tag[i, set, way]):x}")
+    for mem_range, (start_addr, _, mem_data) in zip(
+        test.mem_ranges, self.mem_ranges):
+      offsets = np.flatnonzero(
+        np.frombuffer(mem_data, dtype=np.uint8) !=
+        np.asarray(mem_range.mem_data))
+      if len(offsets):
+        diffs.append(
+          f"Main memory: {len(offsets)} bytes differ, the first one at "
+          f"{hex(start_addr + int(offsets[0]))}")
+    return diffs
+
+
+def build_initial_state(params, test_seed, target_dir, log_file):
+  """RandomTest with the initial state generated for test_seed, whose
+  files are written to target_dir."""
+  seed(test_seed)
+  np.random.seed(test_seed)
+  return RandomTest(
+    **params, target_dir=target_dir, check=False, debug=False,
+    log_file=log_file, log_format="jsonl")
+
+
+if __name__ == "__main__":
+  import argparse
+  import sys
+  parser = argparse.ArgumentParser(
+    description=('Execute the transactions of a RandomTest with a '
+                 'reference model of the caches and the interconnect')
+  )
+  parser.add_argument(
+    '--addr_width',
+    type=int,
+    default=32,
+    help='AXI address width'
+  )
+  parser.add_argument(
+    '--data_width',
+    type=int,
+    default=64,
+    help='AXI data width'
+  )
+  parser.add_argument(
+    '--word_width',
+    type=int,
+    default=64,
+    help='Width of a word in the cache'
+  )
+  parser.add_argument(
+    '--cacheline_words',
+    type=int,
+    default=4,
+    help='Number of words in a cacheline'
+  )
+  parser.add_argument(
+    '--ways',
+    type=int,
+    default=2,
+    help='Number of ways in the cache'
+  )
+  parser.add_argument(
+    '--sets',
+    type=int,
+    default=16,
+    help='Number of sets in the cache'
+  )
+  parser.add_argument(
+    '--n_caches',
+    type=int,
+    default=4,
+    help='Number of cached masters'
+  )
+  parser.add_argument(
+    '--n_transactions',
+    type=int,
+    default=100,
+    help='Number of transactions generated per cached master'
+  )
+  parser.add_argument(
+    '--vectorized_txns',
+    action='store_true',
+    help="The transactions were generated with --vectorized_txns"
+  )
+  parser.add_argument(
+    '--seed',
+    type=int,
+    default=1,
+    help='Seed the initial state was generated with'
+  )
+  parser.add_argument(
+    '--target_dir',
+    type=str,
+    default='build',
+    help='Directory with the txns_*.txt files (and the traces)'
+  )
+  parser.add_argument(
+    '--compare',
+    action='store_true',
+    help=("Also reconstruct the final state from the simulation traces in "
+          "TARGET_DIR and compare it with the one of the model")
+  )
+  args = parser.parse_args()
+
+  params = {
+    name: getattr(args, name) for name in [
+      "addr_width", "data_width", "word_width", "cacheline_words", "ways",
+      "sets", "n_caches", "n_transactions", "vectorized_txns"]
+  }
+  errors = False
+  # The initial state is generated again from the seed, in a temporary
+  # directory so that the files of the simulation are left untouched
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    test = build_initial_state(
+      params, args.seed, tmp_dir,
+      os.path.join(args.target_dir, "moesi_model.jsonl"))
+    model = MoesiModel(test)
+    start = time.perf_counter()
+    n_txns = model.run([
+      os.path.join(args.target_dir, f"txns_{i}.txt")
+      for i in range(args.n_caches)])
+    run_time = time.perf_counter() - start
+    print(f"Executed {n_txns} transactions in {run_time:.2f} s "
+          f"({n_txns / run_time:.0f} transactions/s)")
+    for name, n in sorted(model.counters.items()):
+      print(f"  {name}: {n}")
+
+    model.apply(test)
+    if test.check_coherency():
+      print(f"The final state is not coherent, see "
+            f"{os.path.join(args.target_dir, 'moesi_model.jsonl')}")
+      errors = True
+
+    if args.compare:
+      sim_test = build_initial_state(
+        params, args.seed, tmp_dir,
+        os.path.join(args.target_dir, "cache_python.jsonl"))
+      sim_test.target_dir = args.target_dir
+      errors |= bool(sim_test.reconstruct_state())
+      diffs = model.compare(sim_test)
+      for diff in diffs:
+        print(diff)
+      if diffs:
+        print(f"{len(diffs)} differences between the model and the "
+              "simulation")
+        errors = True
+  sys.exit(1 if errors else 0)
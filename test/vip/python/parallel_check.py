@@ -0,0 +1,358 @@
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
+from itertools import islice
+from common import MemoryRange
+from metrics import Metrics
+from event_log import LEVELS
+import numpy as np
+
+
+def share_array(array):
+  """Copy an array into a new shared memory block.
+  Returns (shm, view, spec); spec is used by attach_array."""
+  shm = SharedMemory(create=True, size=max(array.nbytes, 1))
+  view = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+  view[...] = array
+  return shm, view, (shm.name, array.shape, array.dtype.str)
+
+
+def attach_array(spec):
+  """Returns (shm, view) of an array shared with share_array."""
+  name, shape, dtype = spec
+  shm = SharedMemory(name=name)
+  return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+# State of a worker process
+_worker_test = None
+_worker_shms = []
+
+
+def get_level_name(level):
+  return next(name for name, value in LEVELS.items() if value == level)
+
+
+def get_test_config(test):
+  """Arguments to rebuild a CacheCoherencyTest, without its state,
+  in a worker process."""
+  config = {
+    "params": {
+      "addr_width": test.aw,
+      "data_width": test.dw,
+      "word_width": test.word_width,
+      "cacheline_words": test.cacheline_words,
+      "ways": test.ways,
+      "sets": test.sets,
+      "n_caches": test.n_caches,
+      "n_transactions": test.n_transactions,
+      "target_dir": test.target_dir,
+      "check": False,
+      "debug": False,
+      "incremental": test.incremental,
+      "full_check_interval": test.full_check_interval,
+      "batched_check": test.batched_check,
+      "trace_format": test.trace_format,
+      "log_level": get_level_name(test.events.level),
+    },
+    "mem_ranges": [],
+  }
+  for mem_range in test.mem_ranges:
+    spec = {
+      "start_addr": mem_range.start_addr,
+      "end_addr": mem_range.end_addr,
+      "backing_file": mem_range.backing_file,
+      "sparse": mem_range.sparse,
+      "page_bytes": mem_range.page_bytes,
+      "cached_region": None,
+      "shared_region": None,
+      "mem_data": None,
+    }
+    if mem_range.cached_region:
+      spec["cached_region"] = (mem_range.cached_region.start_addr,
+                               mem_range.cached_region.end_addr)
+    if mem_range.shared_region:
+      spec["shared_region"] = (mem_range.shared_region.start_addr,
+                               mem_range.shared_region.end_addr)
+    config["mem_ranges"].append(spec)
+  return config
+
+
+def build_test(config):
+  """Build the CacheCoherencyTest of a worker. Its events are kept in
+  memory, to be returned to the main process.
+  The data of the memory ranges is not allocated."""
+  global _worker_test
+  # Imported here, since cache_coherency_test imports this module
+  from cache_coherency_test import CacheCoherencyTest
+
+  test = CacheCoherencyTest(**config["params"], log_file=None)
+  for spec in config["mem_ranges"]:
+    mem_range = MemoryRange(
+      start_addr=spec["start_addr"],
+      end_addr=spec["end_addr"],
+      backing_file=spec["backing_file"],
+      sparse=spec["sparse"],
+      page_bytes=spec["page_bytes"])
+    if spec["cached_region"]:
+      mem_range.set_cached_region(*spec["cached_region"])
+    if spec["shared_region"]:
+      mem_range.set_shared_region(*spec["shared_region"])
+    test.add_memory_range(mem_range)
+
+  _worker_test = test
+  return test
+
+
+def init_worker(config):
+  """Build a CacheCoherencyTest on the shared cache and memory state."""
+  test = build_test(config)
+  arrays = []
+  for spec in config["cache_arrays"]:
+    shm, view = attach_array(spec)
+    _worker_shms.append(shm)
+    arrays.append(view)
+  for i, cache in enumerate(test.caches):
+    cache.init_cache(
+      cache_status=arrays[0][i],
+      cache_tag=arrays[1][i],
+      cache_data=arrays[2][i])
+  test._cache_arrays = tuple(arrays)
+
+  for mem_range, spec in zip(test.mem_ranges, config["mem_ranges"]):
+    if spec["sparse"]:
+      # Checked in the main process
+      continue
+    if spec["backing_file"] is not None:
+      mem_range.alloc_mem(mode="r")
+    else:
+      shm, mem_range.mem_data = attach_array(spec["mem_data"])
+      _worker_shms.append(shm)
+
+
+def check_shard(range_idx, lines, holders):
+  """Check the given cache lines of one memory range.
+  Returns (error, events, metrics state)."""
+  test = _worker_test
+  test.events.take()
+  test.metrics = Metrics()
+  test.outstanding_index.holders = holders
+  mem_range = test.mem_ranges[range_idx]
+  if test.batched_check:
+    error = test.check_range_batched(mem_range, lines)
+  else:
+    error = test.check_range(mem_range, lines)
+  return error, test.events.take(), test.metrics.get_state()
+
+
+class ParallelChecker:
+  """Runs the coherency checks of a CacheCoherencyTest in a process pool.
+  The cache and memory state is moved to shared memory once, and the
+  workers check it in place. The cache lines of each memory range are
+  split into shards by their set index. The events of the workers are
+  merged in address order, so that they are identical to the ones of a
+  serial check. Sparse memory ranges, and ranges with fewer than
+  min_lines lines to check, are checked in the main process.
+  """
+  def __init__(self, test, jobs, events, min_lines=1024):
+    self.test = test
+    self.jobs = jobs
+    self.events = events
+    self.min_lines = min_lines
+    self.pool = None
+    self.shms = []
+
+  def share_state(self):
+    test = self.test
+    config = get_test_config(test)
+    config["cache_arrays"] = []
+
+    views = []
+    for array in test.get_cache_arrays():
+      shm, view, spec = share_array(array)
+      self.shms.append(shm)
+      views.append(view)
+      config["cache_arrays"].append(spec)
+    for i, cache in enumerate(test.caches):
+      cache.init_cache(
+        cache_status=views[0][i],
+        cache_tag=views[1][i],
+        cache_data=views[2][i])
+    test._cache_arrays = tuple(views)
+
+    for mem_range, spec in zip(test.mem_ranges, config["mem_ranges"]):
+      if mem_range.backing_file is None and not mem_range.sparse:
+        # File-backed ranges are mapped by the workers themselves
+        shm, mem_range.mem_data, spec["mem_data"] = \
+          share_array(mem_range.mem_data)
+        self.shms.append(shm)
+    return config
+
+  def unshare_state(self):
+    """Move the state back to private memory."""
+    test = self.test
+    arrays = tuple(np.array(array) for array in test.get_cache_arrays())
+    for i, cache in enumerate(test.caches):
+      cache.init_cache(
+        cache_status=arrays[0][i],
+        cache_tag=arrays[1][i],
+        cache_data=arrays[2][i])
+    test._cache_arrays = arrays
+    for mem_range in test.mem_ranges:
+      if mem_range.backing_file is None and not mem_range.sparse:
+        mem_range.mem_data = np.array(mem_range.mem_data)
+
+  def start(self):
+    config = self.share_state()
+    self.pool = get_context().Pool(
+      self.jobs, initializer=init_worker, initargs=(config,))
+
+  def close(self):
+    if self.pool is not None:
+      self.pool.close()
+      self.pool.join()
+      self.pool = None
+    self.unshare_state()
+    for shm in self.shms:
+      try:
+        shm.close()
+      except BufferError:
+        # A view of the block is still referenced, the memory is
+        # released when it goes away
+        pass
+      shm.unlink()
+    self.shms = []
+
+  def get_shards(self, lines):
+    """Split an array of cacheline addresses by set index."""
+    geometry = self.test.caches[0]
+    sets = (lines & geometry.index_mask) >> geometry.block_offset_bits
+    shard_idx = sets * self.jobs // self.test.sets
+    return [lines[shard_idx == shard] for shard in range(self.jobs)]
+
+  def check(self, addrs=None):
+    """Parallel version of the per range loop of check_coherency."""
+    test = self.test
+    holders = dict(test.outstanding_index.holders)
+    pending = []
+    for range_idx, mem_range in enumerate(test.mem_ranges):
+      if addrs is None and not mem_range.sparse:
+        lines = np.arange(
+          mem_range.start_addr,
+          mem_range.end_addr,
+          test.cacheline_bytes,
+          dtype=np.uint64)
+      else:
+        lines = np.array(
+          test.get_check_addrs(mem_range, addrs), dtype=np.uint64)
+      if len(lines) < self.min_lines or mem_range.sparse:
+        pending.append((mem_range, lines, None))
+        continue
+      tasks = [
+        (range_idx, shard.tolist(), holders)
+        for shard in self.get_shards(lines) if len(shard)
+      ]
+      pending.append(
+        (mem_range, lines, self.pool.starmap_async(check_shard, tasks)))
+
+    error = False
+    for mem_range, lines, result in pending:
+      if result is None:
+        if test.batched_check:
+          new_error = test.check_range_batched(mem_range, lines.tolist())
+        else:
+          new_error = test.check_range(mem_range, lines.tolist())
+        error = error or new_error
+        continue
+      events = []
+      for new_error, shard_events, metrics in result.get():
+        error = error or new_error
+        events += shard_events
+        test.metrics.merge(metrics)
+      # Stable sort by address: the events of an address come from a
+      # single shard
+      events.sort(key=lambda event: event[1])
+      self.events.extend(events)
+    return error
+
+
+def init_segment_worker(config):
+  """Build a CacheCoherencyTest with private state for segment checks."""
+  test = build_test(config)
+  for mem_range in test.mem_ranges:
+    mem_range.backing_file = None
+    mem_range.alloc_mem()
+
+
+def check_segment(checkpoint, n_batches):
+  """Check n_batches batches, starting from a checkpoint.
+  Returns (errors, events, metrics state)."""
+  test = _worker_test
+  test.events.take()
+  test.metrics = Metrics()
+  test.restore_checkpoint(checkpoint)
+  batches = islice(test.get_batches(), n_batches)
+  errors = test.check_batches(batches, start=checkpoint["n_batch"] + 1)
+  for cursor in test.cache_cursors + [test.mem_cursor]:
+    cursor.close()
+  return errors, test.events.take(), test.metrics.get_state()
+
+
+class SegmentedChecker:
+  """Checks the timeline of a CacheCoherencyTest in segments.
+  The traces are replayed once without checking, and a checkpoint of the
+  state is taken every segment_batches timestamps. The segment following
+  each checkpoint is checked in a worker process, while the replay goes
+  on. The events of the segments are logged in order, so that they are
+  identical to the ones of a serial check. At most 2 * jobs segments are
+  in flight, to bound the memory used by the checkpoints.
+  """
+  def __init__(self, test, jobs, segment_batches, events):
+    self.test = test
+    self.jobs = jobs
+    self.segment_batches = segment_batches
+    self.events = events
+    self.errors = False
+
+  def write_result(self, result):
+    errors, events, metrics = result.get()
+    self.errors = self.errors or errors
+    # The segments are replayed twice, their records and timestamps are
+    # only counted once
+    metrics["counters"].pop("cache_records", None)
+    metrics["counters"].pop("mem_records", None)
+    metrics["counters"].pop("mem_runs", None)
+    metrics["counters"].pop("timestamps", None)
+    self.test.metrics.merge(metrics)
+    self.events.extend(events)
+
+  def run(self, start_batch=0):
+    """Check all batches of the test's trace cursors, numbered after
+    start_batch. Leaves the test in its final state.
+    Returns True on errors."""
+    test = self.test
+    self.errors = False
+    in_flight = []
+    with get_context().Pool(
+        self.jobs,
+        initializer=init_segment_worker,
+        initargs=(get_test_config(test),)) as pool:
+      checkpoint = test.get_checkpoint(start_batch)
+      n_batch = start_batch
+      for n_batch, batch in enumerate(
+          test.get_batches(), start=start_batch + 1):
+        test.apply_batch(batch)
+        test.dirty_lines = set()
+        test.retire_batch(batch, log=False)
+        test.save_checkpoint_at(n_batch, batch.time)
+        if n_batch % self.segment_batches == 0:
+          if len(in_flight) >= 2 * self.jobs:
+            self.write_result(in_flight.pop(0))
+          in_flight.append(pool.apply_async(
+            check_segment, (checkpoint, n_batch - checkpoint["n_batch"])))
+          checkpoint = test.get_checkpoint(n_batch, batch.time)
+      if n_batch > checkpoint["n_batch"]:
+        in_flight.append(pool.apply_async(
+          check_segment, (checkpoint, n_batch - checkpoint["n_batch"])))
+      for result in in_flight:
+        self.write_result(result)
+    return self.errors
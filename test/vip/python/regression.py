@@ -0,0 +1,260 @@
+from cache_coherency_test import RandomTest
+from multiprocessing import get_context
+from itertools import product
+from random import seed
+import numpy as np
+import subprocess
+import time
+import os
+
+# Parameters of the matrix and the Makefile variables they are passed as
+MATRIX_PARAMS = {
+  "addr_width": "ADDR_WIDTH",
+  "sets": "SETS",
+  "ways": "WAYS",
+  "n_caches": "NMASTERS",
+  "n_transactions": "NTRANSACTIONS",
+}
+FIXED_PARAMS = {
+  "data_width": "DATA_WIDTH",
+  "word_width": "WORD_WIDTH",
+  "cacheline_words": "CACHELINE_WORDS",
+}
+
+
+def parse_seeds(specs):
+  """Parse seeds given as single values or inclusive ranges ("1-100")."""
+  seeds = []
+  for spec in specs:
+    for part in spec.split(","):
+      if "-" in part:
+        first, last = part.split("-")
+        seeds += list(range(int(first), int(last) + 1))
+      else:
+        seeds.append(int(part))
+  return seeds
+
+
+def get_runs(seeds, matrix, fixed, target_dir):
+  """One run per combination of seed and matrix parameters."""
+  runs = []
+  names = list(matrix)
+  for values in product(*matrix.values()):
+    params = dict(zip(names, values))
+    params.update(fixed)
+    config = "_".join(f"{name}{params[name]}" for name in names)
+    for run_seed in seeds:
+      runs.append({
+        "name": f"{config}_seed{run_seed}",
+        "seed": run_seed,
+        "params": params,
+        "target_dir": os.path.join(target_dir, config, f"seed{run_seed}"),
+      })
+  return runs
+
+
+def run_test(run, sim_cmd=None, check_args=None):
+  """Generate the state of a RandomTest, simulate it and check it.
+  Without sim_cmd, only the initial state is checked.
+  Returns a result dict with status PASS, FAIL, SIM_FAIL or ERROR."""
+  result = {"name": run["name"], "seed": run["seed"], "status": "PASS",
+            "message": "", "gen_time": 0.0, "sim_time": 0.0,
+            "check_time": 0.0}
+  target_dir = run["target_dir"]
+  os.makedirs(target_dir, exist_ok=True)
+  test = None
+  try:
+    start = time.time()
+    seed(run["seed"])
+    np.random.seed(run["seed"])
+    test = RandomTest(
+      **run["params"],
+      **(check_args or {}),
+      target_dir=target_dir,
+      check=False,
+      debug=False,
+      log_file=os.path.join(target_dir, "cache_python.jsonl"),
+      log_format="jsonl")
+    errors = test.initial_errors
+    result["gen_time"] = time.time() - start
+
+    if sim_cmd is not None and not errors:
+      start = time.time()
+      env = dict(os.environ)
+      env["MEM_DIR"] = target_dir
+      env["SEED"] = str(run["seed"])
+      for name, var in {**MATRIX_PARAMS, **FIXED_PARAMS}.items():
+        env[var] = str(run["params"][name])
+      with open(os.path.join(target_dir, "sim.log"), "w") as sim_log:
+        sim = subprocess.run(
+          sim_cmd, shell=True, env=env,
+          stdout=sim_log, stderr=subprocess.STDOUT)
+      result["sim_time"] = time.time() - start
+      if sim.returncode != 0:
+        result["status"] = "SIM_FAIL"
+        result["message"] = f"Simulation exited with {sim.returncode}"
+        return result
+
+      start = time.time()
+      errors = test.reconstruct_state()
+      result["check_time"] = time.time() - start
+    if errors:
+      result["status"] = "FAIL"
+      result["message"] = "Coherency errors, see cache_python.jsonl"
+  except Exception as e:
+    result["status"] = "ERROR"
+    result["message"] = f"{type(e).__name__}: {e}"
+  finally:
+    if test is not None:
+      test.events.close()
+  return result
+
+
+def format_summary(results, wall_time):
+  lines = []
+  width = max([len(result["name"]) for result in results] + [4])
+  lines.append(
+    f"{'Name':<{width}}  {'Status':<8}  {'Gen':>8}  {'Sim':>8}  {'Check':>8}")
+  for result in results:
+    lines.append(
+      f"{result['name']:<{width}}  {result['status']:<8}  "
+      f"{result['gen_time']:8.2f}  {result['sim_time']:8.2f}  "
+      f"{result['check_time']:8.2f}  {result['message']}".rstrip())
+  statuses = [result["status"] for result in results]
+  counts = ", ".join(
+    f"{status}: {statuses.count(status)}"
+    for status in ["PASS", "FAIL", "SIM_FAIL", "ERROR"])
+  passed = statuses.count("PASS") == len(statuses)
+  lines.append("")
+  lines.append(f"{len(results)} runs, {counts}")
+  lines.append(
+    f"Generation {sum(r['gen_time'] for r in results):.2f} s, "
+    f"simulation {sum(r['sim_time'] for r in results):.2f} s, "
+    f"check {sum(r['check_time'] for r in results):.2f} s, "
+    f"wall time {wall_time:.2f} s")
+  lines.append("REGRESSION PASSED" if passed else "REGRESSION FAILED")
+  return "\n".join(lines), passed
+
+
+def run_regression(runs, jobs=None, sim_cmd=None, check_args=None):
+  """Run all runs in a process pool. Returns the results in run order."""
+  # A fresh process per run, so no state is shared between the tests
+  with get_context().Pool(jobs, maxtasksperchild=1) as pool:
+    return pool.starmap(
+      run_test, [(run, sim_cmd, check_args) for run in runs], chunksize=1)
+
+
+if __name__ == "__main__":
+  import argparse
+  import sys
+  parser = argparse.ArgumentParser(
+    description=('Generate and check RandomTest states for a list of seeds '
+                 'and a matrix of parameters in parallel')
+  )
+  parser.add_argument(
+    '--seeds',
+    type=str,
+    nargs='+',
+    default=["1"],
+    help='Seeds to run, as values or inclusive ranges (e.g. 1 2 10-20)'
+  )
+  parser.add_argument(
+    '--addr_width',
+    type=int,
+    nargs='+',
+    default=[32],
+    help='AXI address widths'
+  )
+  parser.add_argument(
+    '--sets',
+    type=int,
+    nargs='+',
+    default=[16],
+    help='Numbers of sets in the cache'
+  )
+  parser.add_argument(
+    '--ways',
+    type=int,
+    nargs='+',
+    default=[2],
+    help='Numbers of ways in the cache'
+  )
+  parser.add_argument(
+    '--n_caches',
+    type=int,
+    nargs='+',
+    default=[4],
+    help='Numbers of cached masters'
+  )
+  parser.add_argument(
+    '--n_transactions',
+    type=int,
+    nargs='+',
+    default=[100],
+    help='Numbers of transactions generated per cached master'
+  )
+  parser.add_argument(
+    '--data_width',
+    type=int,
+    default=64,
+    help='AXI data width'
+  )
+  parser.add_argument(
+    '--word_width',
+    type=int,
+    default=64,
+    help='Width of a word in the cache'
+  )
+  parser.add_argument(
+    '--cacheline_words',
+    type=int,
+    default=4,
+    help='Number of words in a cacheline'
+  )
+  parser.add_argument(
+    '--target_dir',
+    type=str,
+    default='build/regression',
+    help='Directory for the generated files, with one subdirectory per run'
+  )
+  parser.add_argument(
+    '--jobs',
+    type=int,
+    default=None,
+    help='Number of runs in parallel (default: number of CPUs)'
+  )
+  parser.add_argument(
+    '--sim_cmd',
+    type=str,
+    default=None,
+    help=('Shell command that simulates one run. The parameters are passed '
+          'in the environment like in the Makefile (MEM_DIR, SEED, '
+          'ADDR_WIDTH, ...). Without it, only the initial states are checked.')
+  )
+  parser.add_argument(
+    '--incremental',
+    action='store_true',
+    help="Only check the cache lines touched since the previous timestamp"
+  )
+  parser.add_argument(
+    '--batched_check',
+    action='store_true',
+    help="Check the cache lines of all caches at once with array operations"
+  )
+  args = parser.parse_args()
+
+  matrix = {name: getattr(args, name) for name in MATRIX_PARAMS}
+  fixed = {name: getattr(args, name) for name in FIXED_PARAMS}
+  check_args = {
+    "incremental": args.incremental,
+    "batched_check": args.batched_check,
+  }
+  runs = get_runs(parse_seeds(args.seeds), matrix, fixed, args.target_dir)
+  start = time.time()
+  results = run_regression(runs, args.jobs, args.sim_cmd, check_args)
+  summary, passed = format_summary(results, time.time() - start)
+  os.makedirs(args.target_dir, exist_ok=True)
+  with open(os.path.join(args.target_dir, "summary.txt"), "w") as file:
+    file.write(summary + "\n")
+  print(summary)
+  sys.exit(0 if passed else 1)
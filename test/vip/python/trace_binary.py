@@ -0,0 +1,218 @@
+import struct
+from itertools import count, repeat
+import numpy as np
+from cache_state import unpack_status, pack_status
+from trace_reader import \
+  TraceCursor, CacheTraceCursor, MemTraceCursor, CacheRecord, get_mem_records
+
+# File layout: a fixed-size header followed by fixed-width records
+# Header: magic, format version, trace kind, cacheline bytes
+HEADER = struct.Struct("<8sHHI")
+MAGIC = b"ACETRACE"
+VERSION = 1
+CACHE_TRACE = 0
+MEM_TRACE = 1
+
+# Status lists indexed by the packed status, see cache_state.pack_status
+STATUS_LISTS = [unpack_status(packed) for packed in range(8)]
+
+
+def cache_record_dtype(cacheline_bytes):
+  return np.dtype([
+    ("time", "<i8"),
+    ("addr", "<u8"),
+    ("tag", "<u8"),
+    ("set", "<u4"),
+    ("way", "<u4"),
+    ("initiator", "u1"),
+    ("modify", "u1"),
+    ("status", "u1"),
+    ("data", "u1", (cacheline_bytes,)),
+  ])
+
+
+MEM_RECORD_DTYPE = np.dtype([
+  ("time", "<i8"),
+  ("addr", "<u8"),
+  ("data", "u1"),
+])
+
+
+def read_header(file):
+  """Returns (kind, cacheline_bytes) of a binary trace."""
+  with open(file, "rb") as trace_file:
+    header = trace_file.read(HEADER.size)
+  if len(header) < HEADER.size:
+    raise Exception(f"{file} is not a binary trace")
+  magic, version, kind, cacheline_bytes = HEADER.unpack(header)
+  if magic != MAGIC:
+    raise Exception(f"{file} is not a binary trace")
+  if version != VERSION:
+    raise Exception(f"Unsupported binary trace version {version}")
+  return kind, cacheline_bytes
+
+
+def load_trace(file):
+  """Memory-map the records of a binary trace as a structured array.
+  Returns (kind, records). A partially written last record is ignored."""
+  kind, cacheline_bytes = read_header(file)
+  if kind == CACHE_TRACE:
+    dtype = cache_record_dtype(cacheline_bytes)
+  else:
+    dtype = MEM_RECORD_DTYPE
+  with open(file, "rb") as trace_file:
+    trace_file.seek(0, 2)
+    n_records = (trace_file.tell() - HEADER.size) // dtype.itemsize
+  if n_records == 0:
+    return kind, np.zeros(0, dtype=dtype)
+  records = np.memmap(
+    file, dtype=dtype, mode="r", offset=HEADER.size, shape=(n_records,))
+  return kind, records
+
+
+class BinaryTraceCursor(TraceCursor):
+  """TraceCursor over a binary trace.
+  The offset in the cursor state counts records instead of bytes.
+  Records are decoded in chunks of `chunk_records` by parse_block."""
+  chunk_records = 65536
+
+  def __init__(self, file):
+    super().__init__(file)
+    self._trace = None
+
+  @property
+  def trace(self):
+    if self._trace is None:
+      _, self._trace = load_trace(self.file)
+    return self._trace
+
+  def read_block(self):
+    """Decode the next chunk of records. Returns False at the end of the
+    trace."""
+    offset = self._read_offset
+    chunk = self.trace[offset:offset + self.chunk_records]
+    if not len(chunk):
+      return False
+    self._read_offset = offset + len(chunk)
+    self._records, self._record_offsets = self.parse_block(chunk, offset)
+    self._pos = 0
+    self.seen_time = max(self.seen_time, self._records[-1].time)
+    return True
+
+  def close(self):
+    self._trace = None
+
+  def __getstate__(self):
+    state = super().__getstate__()
+    state["_trace"] = None
+    return state
+
+
+class BinaryCacheTraceCursor(BinaryTraceCursor):
+  def parse_block(self, records, offset):
+    records = np.asarray(records)
+    rows = zip(
+      records["time"].tolist(),
+      records["addr"].tolist(),
+      records["initiator"].tolist(),
+      records["modify"].tolist(),
+      records["set"].tolist(),
+      records["way"].tolist(),
+      records["tag"].tolist(),
+      records["status"].tolist(),
+      map(bytes, records["data"])
+    )
+    return [
+      CacheRecord(time, addr, bool(initiator), set, way, tag,
+                  STATUS_LISTS[status], data)
+      if modify else CacheRecord(time, addr, bool(initiator))
+      for time, addr, initiator, modify, set, way, tag, status, data in rows
+    ], range(offset, offset + len(records))
+
+
+class BinaryMemTraceCursor(BinaryTraceCursor):
+  def parse_block(self, records, offset):
+    records = np.asarray(records)
+    records, starts = get_mem_records(
+      records["time"], records["addr"], records["data"])
+    return records, (starts + offset).tolist()
+
+
+def convert_cache_trace(src, dst, cacheline_bytes, chunk_records=65536):
+  """Convert a cache_diff_*.txt trace to the binary format."""
+  dtype = cache_record_dtype(cacheline_bytes)
+  empty_line = cacheline_bytes * [0]
+  cursor = CacheTraceCursor(src)
+  with open(dst, "wb") as bin_file:
+    bin_file.write(HEADER.pack(MAGIC, VERSION, CACHE_TRACE, cacheline_bytes))
+    while True:
+      chunk = []
+      while len(chunk) < chunk_records:
+        record = cursor.pop()
+        if record is None:
+          break
+        if record.modify:
+          chunk.append((
+            record.time, record.addr, record.tag, record.set, record.way,
+            record.initiator, True, pack_status(record.status),
+            np.frombuffer(record.data, dtype=np.uint8)))
+        else:
+          chunk.append((
+            record.time, record.addr, 0, 0, 0,
+            record.initiator, False, 0, empty_line))
+      if not chunk:
+        break
+      bin_file.write(np.array(chunk, dtype=dtype).tobytes())
+  cursor.close()
+
+
+def convert_mem_trace(src, dst, chunk_records=1 << 20):
+  """Convert a main_mem_diff.txt trace to the binary format."""
+  cursor = MemTraceCursor(src)
+  with open(dst, "wb") as bin_file:
+    bin_file.write(HEADER.pack(MAGIC, VERSION, MEM_TRACE, 0))
+    while True:
+      chunk = []
+      while len(chunk) < chunk_records:
+        record = cursor.pop()
+        if record is None:
+          break
+        chunk.extend(zip(
+          repeat(record.time), count(record.addr), record.data))
+      if not chunk:
+        break
+      bin_file.write(np.array(chunk, dtype=MEM_RECORD_DTYPE).tobytes())
+  cursor.close()
+
+
+if __name__ == "__main__":
+  import argparse
+  import os
+  parser = argparse.ArgumentParser(
+    description=('Convert the cache_diff_*.txt and main_mem_diff.txt '
+                 'traces of a simulation to the binary trace format')
+  )
+  parser.add_argument(
+    '--target_dir',
+    type=str,
+    help='Directory with the traces'
+  )
+  parser.add_argument(
+    '--n_caches',
+    type=int,
+    help='Number of cached masters in the test'
+  )
+  parser.add_argument(
+    '--cacheline_bytes',
+    type=int,
+    help='Number of bytes in a cacheline'
+  )
+  args = parser.parse_args()
+  for i in range(args.n_caches):
+    convert_cache_trace(
+      os.path.join(args.target_dir, f"cache_diff_{i}.txt"),
+      os.path.join(args.target_dir, f"cache_diff_{i}.bin"),
+      args.cacheline_bytes)
+  convert_mem_trace(
+    os.path.join(args.target_dir, "main_mem_diff.txt"),
+    os.path.join(args.target_dir, "main_mem_diff.bin"))
@@ -0,0 +1,353 @@
+from cache_state import \
+  CachelineState, CachelineStateEnum, StateBits, VALID_MASK, STATE_LUT, \
+  pack_status
+from random import Random
+import numpy as np
+
+DIRTY_MASK = 1 << StateBits.DIRTY_IDX.value
+
+# Packed status of each state
+STATUS = {
+  state: pack_status(CachelineState(state).get_state_bits())
+  for state in CachelineStateEnum
+}
+
+
+class TraceGenerator:
+  """Writes the traces of a simulation without running one.
+  Random loads, stores and evictions of the cached masters are applied to
+  a copy of the cache and memory state of a CacheCoherencyTest, following
+  the MOESI transitions, and logged like cache_scoreboard.svh and
+  mem_logger.svh do:
+    - A load miss is filled from the owner (M -> O) or from an
+      exclusive copy (E -> S), or from main memory in E state if no other
+      cache holds the line. The requester gets S if other copies remain.
+    - A store invalidates all other copies and leaves the line in M state.
+    - An eviction writes dirty data back to main memory.
+  A full set is made room in by evicting a random way. Snooped caches log
+  their rows with INITIATOR:0 at the time of the transaction, so the state
+  is coherent at every timestamp, and the traces pass the coherency check.
+  The state of the test itself is not modified.
+  """
+  def __init__(
+      self,
+      test,
+      seed=None,
+      hot_lines=64,
+      hot_odds=0.7,
+      store_odds=0.4,
+      evict_odds=0.1,
+      time_steps=(2, 4, 6, 10),
+  ):
+    """
+    Parameters
+    ==========
+      test CacheCoherencyTest with its initial state.\n
+      seed Seed of the generator.\n
+      hot_lines Number of cache lines most transactions go to, to cause
+      snoops and conflicts.\n
+      hot_odds Odds of a transaction to go to one of the hot lines.\n
+      store_odds Odds of a transaction to be a store.\n
+      evict_odds Odds of a transaction to be an eviction.\n
+      time_steps Simulation time between transactions, chosen at random.\n
+    """
+    self.test = test
+    self.rng = Random(seed)
+    self.hot_odds = hot_odds
+    self.store_odds = store_odds
+    self.evict_odds = evict_odds
+    self.time_steps = time_steps
+    self.geometry = test.caches[0]
+    self.cacheline_bytes = test.cacheline_bytes
+    self.time = 0
+
+    status, tag, data = test.get_cache_arrays()
+    self.cache_status = np.array(status)
+    self.cache_tag = np.array(tag)
+    self.cache_data = np.array(data)
+
+    # Cacheline addresses of the cached and shared regions, with the
+    # memory range they belong to
+    self.mem_data = []
+    self.lines = []
+    for range_idx, mem_range in enumerate(test.mem_ranges):
+      self.mem_data.append(np.array(mem_range.mem_data))
+      try:
+        start_addr, end_addr = mem_range.get_cached_shared_bounds()
+      except Exception:
+        continue
+      start_addr = max(start_addr, mem_range.start_addr)
+      end_addr = min(end_addr, mem_range.end_addr)
+      self.lines += [
+        (range_idx, addr)
+        for addr in range(start_addr, end_addr, self.cacheline_bytes)
+      ]
+    if not self.lines:
+      raise Exception("No cached and shared memory to generate traces for")
+    self.hot_lines = self.rng.sample(
+      self.lines, min(hot_lines, len(self.lines)))
+
+    # Fields are written with the widths of the SystemVerilog types
+    self.addr_digits = (test.aw + 3) // 4
+    self.tag_digits = (self.geometry.tag_bits + 3) // 4
+
+    self.cache_lines = [[] for _ in range(test.n_caches)]
+    self.mem_lines = []
+
+  def get_hit_way(self, cache_idx, addr):
+    """Returns the way holding addr in a cache, or None."""
+    set = self.geometry.get_index(addr)
+    hits = np.flatnonzero(
+      (self.cache_tag[cache_idx, set] == self.geometry.get_tag(addr)) &
+      ((self.cache_status[cache_idx, set] & VALID_MASK) != 0))
+    if len(hits) == 0:
+      return None
+    return int(hits[-1])
+
+  def get_state(self, cache_idx, set, way):
+    return CachelineStateEnum(
+      STATE_LUT[self.cache_status[cache_idx, set, way]])
+
+  def log_cache(self, cache_idx, addr, initiator, way=None):
+    """Log a row of a cache trace. With a way, the new content of the
+    entry is logged as well."""
+    line = f"TIME:{self.time} ADDR:{addr:0{self.addr_digits}x} " \
+      f"INITIATOR:{int(initiator)}"
+    if way is not None:
+      set = self.geometry.get_index(addr)
+      data = ",".join(
+        f"{byte:02x}" for byte in self.cache_data[cache_idx, set, way].tolist())
+      line += f" SET:{set} WAY:{way} " \
+        f"TAG:{int(self.cache_tag[cache_idx, set, way]):0{self.tag_digits}x} " \
+        f"STATUS:{int(self.cache_status[cache_idx, set, way]):03b} " \
+        f"DATA:[{data}]"
+    self.cache_lines[cache_idx].append(line + "\n")
+
+  def write_back(self, range_idx, addr, data):
+    """Write a dirty cache line to main memory."""
+    mem_range = self.test.mem_ranges[range_idx]
+    offset = addr - mem_range.start_addr
+    self.mem_data[range_idx][offset:offset + self.cacheline_bytes] = data
+    self.mem_lines.append(f"TIME:{self.time}\n")
+    for i, byte in enumerate(data.tolist()):
+      self.mem_lines.append(
+        f"ADDR:{addr + i:0{self.addr_digits}x} DATA:{byte:02x}\n")
+
+  def get_range_idx(self, addr):
+    for range_idx, mem_range in enumerate(self.test.mem_ranges):
+      if mem_range.start_addr <= addr < mem_range.end_addr:
+        return range_idx
+    raise Exception(f"Address {hex(addr)} outside the memory range(s)")
+
+  def evict(self, cache_idx, set, way):
+    """Invalidate an entry, writing it back if it is dirty."""
+    if self.cache_status[cache_idx, set, way] & DIRTY_MASK:
+      addr = self.geometry.get_line_addr(
+        int(self.cache_tag[cache_idx, set, way]), set)
+      self.write_back(
+        self.get_range_idx(addr), addr, self.cache_data[cache_idx, set, way])
+    self.cache_status[cache_idx, set, way] = STATUS[CachelineStateEnum.INVALID]
+
+  def allocate(self, cache_idx, addr):
+    """Returns a way for addr in a cache, evicting a random way of a full
+    set."""
+    set = self.geometry.get_index(addr)
+    free_ways = np.flatnonzero(
+      (self.cache_status[cache_idx, set] & VALID_MASK) == 0)
+    if len(free_ways):
+      return int(free_ways[0])
+    way = self.rng.randrange(self.test.ways)
+    self.evict(cache_idx, set, way)
+    return way
+
+  def load(self, cache_idx, range_idx, addr, holders):
+    set = self.geometry.get_index(addr)
+    if cache_idx in holders:
+      self.log_cache(cache_idx, addr, True)
+      return
+    mem_range = self.test.mem_ranges[range_idx]
+    offset = addr - mem_range.start_addr
+    data = self.mem_data[range_idx][offset:offset + self.cacheline_bytes]
+    for idx, way in holders.items():
+      state = self.get_state(idx, set, way)
+      if state in [CachelineStateEnum.MODIFIED, CachelineStateEnum.OWNED]:
+        data = self.cache_data[idx, set, way]
+      if state == CachelineStateEnum.MODIFIED:
+        self.cache_status[idx, set, way] = STATUS[CachelineStateEnum.OWNED]
+        self.log_cache(idx, addr, False, way)
+      elif state == CachelineStateEnum.EXCLUSIVE:
+        self.cache_status[idx, set, way] = STATUS[CachelineStateEnum.SHARED]
+        self.log_cache(idx, addr, False, way)
+      else:
+        self.log_cache(idx, addr, False)
+    data = np.array(data)
+    way = self.allocate(cache_idx, addr)
+    self.cache_data[cache_idx, set, way] = data
+    self.cache_tag[cache_idx, set, way] = self.geometry.get_tag(addr)
+    if holders:
+      self.cache_status[cache_idx, set, way] = STATUS[CachelineStateEnum.SHARED]
+    else:
+      self.cache_status[cache_idx, set, way] = \
+        STATUS[CachelineStateEnum.EXCLUSIVE]
+    self.log_cache(cache_idx, addr, True, way)
+
+  def store(self, cache_idx, range_idx, addr, holders):
+    set = self.geometry.get_index(addr)
+    data = None
+    for idx, way in holders.items():
+      if self.cache_status[idx, set, way] & DIRTY_MASK:
+        data = np.array(self.cache_data[idx, set, way])
+      if idx != cache_idx:
+        self.cache_status[idx, set, way] = \
+          STATUS[CachelineStateEnum.INVALID]
+        self.log_cache(idx, addr, False, way)
+    way = holders.get(cache_idx)
+    if way is None:
+      if data is None:
+        mem_range = self.test.mem_ranges[range_idx]
+        offset = addr - mem_range.start_addr
+        data = self.mem_data[range_idx][offset:offset + self.cacheline_bytes]
+      way = self.allocate(cache_idx, addr)
+      self.cache_data[cache_idx, set, way] = data
+      self.cache_tag[cache_idx, set, way] = self.geometry.get_tag(addr)
+    # Write one word of the line
+    word_bytes = self.test.word_width // 8
+    start = self.rng.randrange(0, self.cacheline_bytes, word_bytes)
+    self.cache_data[cache_idx, set, way, start:start + word_bytes] = \
+      [self.rng.randrange(256) for _ in range(word_bytes)]
+    self.cache_status[cache_idx, set, way] = STATUS[CachelineStateEnum.MODIFIED]
+    self.log_cache(cache_idx, addr, True, way)
+
+  def step(self):
+    """Generate one transaction."""
+    self.time += self.rng.choice(self.time_steps)
+    if self.rng.random() < self.hot_odds:
+      range_idx, addr = self.rng.choice(self.hot_lines)
+    else:
+      range_idx, addr = self.rng.choice(self.lines)
+    cache_idx = self.rng.randrange(self.test.n_caches)
+    holders = {}
+    for idx in range(self.test.n_caches):
+      way = self.get_hit_way(idx, addr)
+      if way is not None:
+        holders[idx] = way
+
+    op = self.rng.random()
+    if op < self.evict_odds and cache_idx in holders:
+      way = holders[cache_idx]
+      self.evict(cache_idx, self.geometry.get_index(addr), way)
+      self.log_cache(cache_idx, addr, True, way)
+    elif op < self.evict_odds + self.store_odds:
+      self.store(cache_idx, range_idx, addr, holders)
+    else:
+      self.load(cache_idx, range_idx, addr, holders)
+
+  def flush(self, cache_files, mem_file):
+    for lines, file in zip(self.cache_lines, cache_files):
+      file.write("".join(lines))
+      lines.clear()
+    mem_file.write("".join(self.mem_lines))
+    self.mem_lines.clear()
+
+  def generate(self, n_events, chunk_events=65536):
+    """Write n_events transactions to the trace files of the test.
+    Returns the number of lines written to each file."""
+    cache_files = [
+      open(file, "w") for file in self.test.get_cache_trace_files()]
+    mem_file = open(self.test.get_mem_trace_file(), "w")
+    files = self.test.get_cache_trace_files() + \
+      [self.test.get_mem_trace_file()]
+    n_lines = dict.fromkeys(files, 0)
+    try:
+      for start in range(0, n_events, chunk_events):
+        for _ in range(min(chunk_events, n_events - start)):
+          self.step()
+        for file, lines in zip(files, self.cache_lines + [self.mem_lines]):
+          n_lines[file] += len(lines)
+        self.flush(cache_files, mem_file)
+    finally:
+      for file in cache_files + [mem_file]:
+        file.close()
+    return n_lines
+
+
+if __name__ == "__main__":
+  import argparse
+  from random import seed
+  from cache_coherency_test import RandomTest
+  parser = argparse.ArgumentParser(
+    description=('Generate the initial state of a RandomTest and synthetic '
+                 'traces of a simulation starting from it')
+  )
+  parser.add_argument(
+    '--addr_width',
+    type=int,
+    default=32,
+    help='AXI address width'
+  )
+  parser.add_argument(
+    '--data_width',
+    type=int,
+    default=64,
+    help='AXI data width'
+  )
+  parser.add_argument(
+    '--word_width',
+    type=int,
+    default=64,
+    help='Width of a word in the cache'
+  )
+  parser.add_argument(
+    '--cacheline_words',
+    type=int,
+    default=4,
+    help='Number of words in a cacheline'
+  )
+  parser.add_argument(
+    '--ways',
+    type=int,
+    default=2,
+    help='Number of ways in the cache'
+  )
+  parser.add_argument(
+    '--sets',
+    type=int,
+    default=16,
+    help='Number of sets in the cache'
+  )
+  parser.add_argument(
+    '--n_caches',
+    type=int,
+    default=4,
+    help='Number of cached masters'
+  )
+  parser.add_argument(
+    '--n_transactions',
+    type=int,
+    default=100,
+    help='Number of transactions generated per cached master'
+  )
+  parser.add_argument(
+    '--n_events',
+    type=int,
+    default=10000,
+    help='Number of transactions in the traces'
+  )
+  parser.add_argument(
+    '--target_dir',
+    type=str,
+    default='build/mem',
+    help='Target directory for generated files'
+  )
+  parser.add_argument(
+    '--seed',
+    type=int,
+    default=1,
+    help='Seed of the initial state and the traces'
+  )
+  args = vars(parser.parse_args())
+  n_events = args.pop("n_events")
+  seed(args["seed"])
+  np.random.seed(args["seed"])
+  test = RandomTest(**args, check=False, debug=False)
+  TraceGenerator(test, seed=args["seed"]).generate(n_events)
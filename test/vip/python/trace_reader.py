@@ -0,0 +1,597 @@
+from abc import ABC, abstractmethod
+from heapq import heapify, heapreplace, heappop
+from typing import Callable, Iterator, List, NamedTuple, Optional
+import numpy as np
+import os
+import re
+import time as wall_time
+
+
+class CacheRecord(NamedTuple):
+  """A single line of a `cache_diff_*.txt` trace.
+  `set`, `way`, `tag`, `status` and `data` are None for rows that
+  only mark a finished (or snooped) transaction without modifying
+  the cache. `data` holds the bytes of the cache line.
+  """
+  time: int
+  addr: int
+  initiator: bool
+  set: Optional[int] = None
+  way: Optional[int] = None
+  tag: Optional[int] = None
+  status: Optional[List[bool]] = None
+  data: Optional[bytes] = None
+
+  @property
+  def modify(self):
+    return self.data is not None
+
+
+class MemRecord(NamedTuple):
+  """Bytes written to consecutive main memory addresses
+  (`main_mem_diff.txt`). mem_logger logs a burst byte by byte, the bytes
+  of consecutive lines are read as one record.
+  `time` is taken from the last preceding TIME line."""
+  time: int
+  addr: int
+  data: bytes
+
+
+def get_mem_records(times, addrs, data):
+  """Split main memory writes, given as arrays of the time, address and
+  data byte of every written byte, into records of consecutive addresses
+  with the same timestamp.
+  Returns the records and the index of the first byte of each one."""
+  n_bytes = len(addrs)
+  if not n_bytes:
+    return [], np.zeros(0, dtype=np.int64)
+  starts = np.flatnonzero(np.concatenate((
+    [True],
+    (times[1:] != times[:-1]) | (addrs[1:] != addrs[:-1] + np.uint64(1)))))
+  ends = np.append(starts[1:], n_bytes)
+  data = data.astype(np.uint8).tobytes()
+  records = [
+    tuple.__new__(MemRecord, (time, addr, data[start:end]))
+    for time, addr, start, end in zip(
+      times[starts].tolist(), addrs[starts].tolist(),
+      starts.tolist(), ends.tolist())
+  ]
+  return records, starts
+
+
+def coalesce_mem_records(records):
+  """Merge main memory records that continue each other on the same
+  timestamp, e.g. a burst split over two blocks of the trace.
+  Returns a list of (addr, bytearray) in file order, so that a byte written
+  twice keeps the later value when the runs are applied in order."""
+  runs = []
+  run = None
+  time = None
+  next_addr = None
+  for record_time, addr, data in records:
+    if addr == next_addr and record_time == time:
+      run += data
+    else:
+      time = record_time
+      run = bytearray(data)
+      runs.append((addr, run))
+    next_addr = addr + len(data)
+  return runs
+
+
+# Fields of a line written by the cache scoreboard (see
+# cache_scoreboard.svh), up to the opening bracket of the data
+CACHE_LINE_RE = re.compile(
+  rb"TIME:(\d+) ADDR:([0-9a-fA-F]+) INITIATOR:([01])"
+  rb"(?: SET:(\d+) WAY:(\d+) TAG:([0-9a-fA-F]+) STATUS:([01]+) DATA:\[)?")
+
+# Timestamp following a TIME field, see TraceCursor.poll
+DIGITS_RE = re.compile(rb"\d+")
+
+# Two digit hex bytes written by the main memory logger, and their bytes
+HEX_BYTES = {f"{byte:02x}".encode(): bytes((byte,)) for byte in range(256)}
+
+
+def get_hex_nibbles():
+  """Returns an array mapping characters to the value of the hex digit,
+  or 255 for characters that are not hex digits."""
+  lut = np.full(256, 255, dtype=np.uint8)
+  for value, char in enumerate("0123456789abcdef"):
+    lut[ord(char)] = value
+    lut[ord(char.upper())] = value
+  return lut
+
+HEX_NIBBLES = get_hex_nibbles()
+
+# Status lists by STATUS field, see get_status
+_status_lists = {}
+
+
+def get_status(payload: bytes) -> List[bool]:
+  """Status bits of a STATUS field, least significant bit first.
+  The lists are shared between records and must not be modified."""
+  status = _status_lists.get(payload)
+  if status is None:
+    status = [char == ord("1") for char in reversed(payload)]
+    _status_lists[payload] = status
+  return status
+
+
+def parse_hex_list(payload: bytes) -> bytes:
+  """Parse a comma separated list of hex bytes."""
+  try:
+    return bytes.fromhex(payload.decode().replace(",", " "))
+  except ValueError:
+    # Not all elements have two digits
+    return bytes(int(x, 16) for x in payload.split(b","))
+
+
+def parse_cache_words(line) -> Optional[CacheRecord]:
+  """Parse a cache trace line word by word, in any field order.
+  Fallback of parse_cache_line for lines that don't match CACHE_LINE_RE.
+  Returns None for empty lines."""
+  if isinstance(line, bytes):
+    line = line.decode()
+  words = line.split()
+  if not words:
+    return None
+  addr = None
+  time = None
+  initiator = None
+  set = None
+  way = None
+  tag = None
+  status = None
+  data = None
+  for word in words:
+    time_idx = word.find("TIME:")
+    initiator_idx = word.find("INITIATOR:")
+    addr_idx = word.find("ADDR:")
+    set_idx = word.find("SET:")
+    way_idx = word.find("WAY")
+    tag_idx = word.find("TAG:")
+    status_idx = word.find("STATUS:")
+    data_idx = word.find("DATA:")
+    payload = word.split(":")[1]
+    if time_idx != -1:
+      time = int(payload)
+    if addr_idx != -1:
+      addr = int(payload, 16)
+    if set_idx != -1:
+      set = int(payload)
+    if initiator_idx != -1:
+      initiator = bool(int(payload))
+    if way_idx != -1:
+      way = int(payload)
+    if tag_idx != -1:
+      tag = int(payload, 16)
+    if status_idx != -1:
+      status = get_status(payload.encode())
+    if data_idx != -1:
+      data = parse_hex_list(payload.strip("[]").encode())
+  if None in [time, addr, initiator]:
+    raise Exception(f"Unexpected line in cache trace: {line.strip()}")
+  if None in [set, way, tag, status, data]:
+    # A row with only time and address present indicates
+    # a finished transaction which wasn't cached but might've
+    # modified other cache lines by snooping
+    return CacheRecord(time, addr, initiator)
+  return CacheRecord(time, addr, initiator, set, way, tag, status, data)
+
+
+def parse_cache_line(line) -> Optional[CacheRecord]:
+  """Parse a line written by the cache scoreboard (bytes or str).
+  Returns None for empty lines."""
+  if isinstance(line, str):
+    line = line.encode()
+  match = CACHE_LINE_RE.match(line)
+  if match is not None:
+    time, addr, initiator, set, way, tag, status = match.groups()
+    rest = line[match.end():].rstrip()
+    # The named tuple constructor with default arguments is bypassed
+    if status is None:
+      if not rest:
+        return tuple.__new__(CacheRecord, (
+          int(time), int(addr, 16), initiator == b"1",
+          None, None, None, None, None))
+    elif rest.endswith(b"]"):
+      return tuple.__new__(CacheRecord, (
+        int(time), int(addr, 16), initiator == b"1", int(set), int(way),
+        int(tag, 16), get_status(status), parse_hex_list(rest[:-1])))
+  return parse_cache_words(line)
+
+
+def parse_mem_block(block, offset, time):
+  """Parse a block of complete main memory trace lines with array
+  operations. mem_logger writes every ADDR line with the same width, so
+  the ADDR lines are decoded as the rows of a byte matrix, without a
+  Python object per line.
+  Returns (records, offsets, time), or None if a line has another layout,
+  in which case the block has to be parsed line by line."""
+  if not block.endswith(b"\n"):
+    # Last line of a finished trace
+    block += b"\n"
+  chars = np.frombuffer(block, dtype=np.uint8)
+  ends = np.flatnonzero(chars == ord("\n"))
+  starts = np.concatenate(([0], ends[:-1] + 1))
+  is_addr = chars[starts] == ord("A")
+  addr_starts = starts[is_addr]
+  if not len(addr_starts):
+    return None
+  # "ADDR:" digits " DATA:" two digits "\n"
+  width = int(ends[is_addr][0] - addr_starts[0]) + 1
+  n_digits = width - 14
+  if n_digits <= 0 or n_digits % 2 or n_digits > 16 or \
+      (ends[is_addr] - addr_starts != width - 1).any():
+    return None
+  rows = chars[addr_starts[:, None] + np.arange(width)]
+  if not ((rows[:, :5] == np.frombuffer(b"ADDR:", dtype=np.uint8)).all() and
+          (rows[:, 5 + n_digits:11 + n_digits] ==
+           np.frombuffer(b" DATA:", dtype=np.uint8)).all()):
+    return None
+  nibbles = HEX_NIBBLES[np.concatenate(
+    [rows[:, 5:5 + n_digits], rows[:, 11 + n_digits:13 + n_digits]], axis=1)]
+  if (nibbles == 255).any():
+    return None
+  # Address bytes, most significant first, followed by the data byte
+  values = (nibbles[:, 0::2] << 4) | nibbles[:, 1::2]
+  addrs = np.zeros(len(rows), dtype=np.uint64)
+  for idx in range(n_digits // 2):
+    addrs <<= np.uint64(8)
+    addrs |= values[:, idx]
+
+  times = [time]
+  for start, end in zip(starts[~is_addr].tolist(), ends[~is_addr].tolist()):
+    if block[start:start + 5] != b"TIME:":
+      return None
+    try:
+      times.append(int(block[start + 5:end]))
+    except ValueError:
+      return None
+  # Every byte gets the time of the last TIME line before it
+  byte_times = np.array(times)[np.cumsum(~is_addr)[is_addr]]
+  records, record_starts = get_mem_records(byte_times, addrs, values[:, -1])
+  return records, (addr_starts[record_starts] + offset).tolist(), times[-1]
+
+
+def parse_mem_words(line, time):
+  """Parse a main memory trace line word by word.
+  Returns (time, record), the record being None for TIME and empty
+  lines."""
+  if isinstance(line, bytes):
+    line = line.decode()
+  addr = None
+  data = None
+  for word in line.split():
+    payload = word.split(":")[1]
+    if word.find("TIME:") != -1:
+      time = int(payload)
+    if word.find("ADDR:") != -1:
+      addr = int(payload, 16)
+    if word.find("DATA:") != -1:
+      data = int(payload, 16)
+  if (addr is not None) and (data is not None):
+    return time, MemRecord(time, addr, bytes((data,)))
+  elif (addr is not None) or (data is not None):
+    raise Exception(
+      "Either data or addr provided without the other"
+    )
+  return time, None
+
+
+class TraceCursor(ABC):
+  """Stateful reader of a trace file.
+  The file is kept open between reads and read in blocks of about
+  `block_bytes`, whose lines are parsed at once. The position of the first
+  record that was not consumed yet is remembered, so consecutive time
+  windows only parse new lines.
+  In follow mode, the file may still be written: a missing file reads as
+  empty and an unterminated last line is left for the next read.
+  Iterating a cursor consumes its records.
+  """
+  block_bytes = 1 << 16
+
+  def __init__(self, file, follow=False):
+    self.file = file
+    self.follow = follow
+    # Largest timestamp read so far
+    self.seen_time = -1
+    # End time of the last window read with read_until
+    self.end_time = None
+    # Time of the last TIME line read, for traces that log it separately
+    self.time = -1
+    self._fh = None
+    # Offset up to which the file was scanned by poll
+    self._scan_offset = 0
+    # Offset up to which the file was read
+    self._read_offset = 0
+    # Records of the last block read, the next one is self._records[self._pos]
+    self._records = []
+    self._pos = 0
+    # Offset of the line of each record in self._records
+    self._record_offsets = []
+
+  @abstractmethod
+  def parse_block(self, block, offset):
+    """Parse a block of the trace starting at offset: the bytes of complete
+    lines of a text trace, or records of a binary trace.
+    Returns the records and the offsets of their lines."""
+
+  def read_block(self):
+    """Parse the next block of lines. Returns False at the end of the file."""
+    if self._fh is None:
+      if self.follow and not os.path.exists(self.file):
+        return False
+      self._fh = open(self.file, "rb")
+      self._fh.seek(self._read_offset)
+    while True:
+      block = self._fh.read(self.block_bytes)
+      if not block:
+        return False
+      if not block.endswith(b"\n"):
+        block += self._fh.readline()
+        if self.follow and not block.endswith(b"\n"):
+          # The line is still being written
+          block = block[:block.rfind(b"\n") + 1]
+          self._fh.seek(self._read_offset + len(block))
+          if not block:
+            return False
+      offset = self._read_offset
+      self._read_offset += len(block)
+      self._records, self._record_offsets = self.parse_block(block, offset)
+      self._pos = 0
+      if self._records:
+        self.seen_time = max(self.seen_time, self._records[-1].time)
+        return True
+      self.seen_time = max(self.seen_time, self.time)
+
+  def poll(self, tail_bytes=4096):
+    """Advance seen_time to the last timestamp of the complete lines
+    written so far, in follow mode. read_block only reads new lines once
+    the buffered records are consumed, so this is what moves the horizon
+    of merge_traces while the records of the latest timestamp are still
+    buffered. Only the end of the new data is searched for a TIME field,
+    in windows of tail_bytes that grow until one is found."""
+    try:
+      size = os.path.getsize(self.file)
+    except OSError:
+      return
+    with open(self.file, "rb") as file:
+      while size > self._scan_offset:
+        start = max(self._scan_offset, size - tail_bytes)
+        file.seek(start)
+        data = file.read(size - start)
+        end = data.rfind(b"\n") + 1
+        pos = data.rfind(b"TIME:", 0, end)
+        if pos != -1:
+          time = int(DIGITS_RE.match(data, pos + 5).group())
+          self.seen_time = max(self.seen_time, time)
+        if pos != -1 or start == self._scan_offset:
+          self._scan_offset = start + end
+          return
+        tail_bytes *= 2
+
+  def peek(self):
+    """Return the next record without consuming it.
+    Returns None at the end of the file."""
+    if self._pos == len(self._records) and not self.read_block():
+      return None
+    return self._records[self._pos]
+
+  def pop(self):
+    """Consume and return the next record."""
+    record = self.peek()
+    if record is not None:
+      self._pos += 1
+    return record
+
+  def __iter__(self):
+    while True:
+      record = self.pop()
+      if record is None:
+        return
+      yield record
+
+  def read_until(self, end_time):
+    """Consume all records with a timestamp up to end_time (inclusive)."""
+    self.end_time = end_time
+    while True:
+      record = self.peek()
+      if (record is None) or (record.time > end_time):
+        return
+      yield self.pop()
+
+  def rewind(self):
+    self.set_state({"offset": 0, "time": -1, "end_time": None})
+
+  def get_state(self):
+    """Position of the first record that was not consumed."""
+    if self._pos < len(self._records):
+      offset = self._record_offsets[self._pos]
+      time = self.get_record_state_time(self._records[self._pos])
+    else:
+      offset = self._read_offset
+      time = self.time
+    return {"offset": offset, "time": time, "end_time": self.end_time}
+
+  def get_record_state_time(self, record):
+    """Value of self.time when the line of record is read."""
+    return self.time
+
+  def set_state(self, state):
+    self.close()
+    self._read_offset = state["offset"]
+    self.time = state["time"]
+    self.end_time = state["end_time"]
+    self._records = []
+    self._record_offsets = []
+    self._pos = 0
+
+  def close(self):
+    if self._fh is not None:
+      self._fh.close()
+      self._fh = None
+
+  def __getstate__(self):
+    # Open files can't be pickled, reopen at the same position instead
+    state = self.__dict__.copy()
+    position = self.get_state()
+    state["_fh"] = None
+    state["_records"] = []
+    state["_record_offsets"] = []
+    state["_pos"] = 0
+    state["_read_offset"] = position["offset"]
+    state["time"] = position["time"]
+    return state
+
+
+class CacheTraceCursor(TraceCursor):
+  def parse_block(self, block, offset):
+    records = []
+    offsets = []
+    for line in block.splitlines(True):
+      record = parse_cache_line(line)
+      if record is not None:
+        records.append(record)
+        offsets.append(offset)
+      offset += len(line)
+    return records, offsets
+
+
+class MemTraceCursor(TraceCursor):
+  """Bytes logged before the first TIME line get time -1."""
+  def parse_block(self, block, offset):
+    parsed = parse_mem_block(block, offset, self.time)
+    if parsed is not None:
+      records, offsets, self.time = parsed
+      return records, offsets
+    records = []
+    offsets = []
+    time = self.time
+    new_record = tuple.__new__
+    for line in block.splitlines(True):
+      if line[:5] == b"ADDR:":
+        fields = line[5:].split(b" DATA:")
+        data = HEX_BYTES.get(fields[-1].rstrip())
+        if len(fields) == 2 and data is not None:
+          records.append(
+            new_record(MemRecord, (time, int(fields[0], 16), data)))
+          offsets.append(offset)
+          offset += len(line)
+          continue
+      time, record = parse_mem_words(line, time)
+      if record is not None:
+        records.append(record)
+        offsets.append(offset)
+      offset += len(line)
+    self.time = time
+    return records, offsets
+
+  def get_record_state_time(self, record):
+    return record.time
+
+
+class TraceBatch:
+  """All trace events up to and including timestamp `time`
+  that were not part of a previous batch."""
+  def __init__(self, n_caches):
+    self.time = None
+    # Records of each cache trace, in file order
+    self.cache_records: List[List[CacheRecord]] = \
+      [[] for _ in range(n_caches)]
+    # Main memory writes, in file order
+    self.mem_records: List[MemRecord] = []
+    # (cache index, address) of the transactions retired on `time`
+    self.retired = []
+
+
+def merge_traces(
+    cache_cursors: List[CacheTraceCursor],
+    mem_cursor: Optional[MemTraceCursor] = None,
+    is_done: Optional[Callable[[], bool]] = None,
+    poll_interval: float = 1.0
+  ) -> Iterator[TraceBatch]:
+  """Walk all cache traces and the main memory trace once, in time order.
+  The traces are merged through a heap keyed on the timestamp of the next
+  record of each file. A batch is yielded for every timestamp on which at
+  least one cache retired a transaction (INITIATOR:1); it holds every event
+  since the previous batch. Events after the last retired transaction are
+  not yielded.
+  When a batch is yielded, the cursors point to the first record of the
+  next batch.
+
+  If is_done is given, the traces are followed while the simulation writes
+  them, until is_done() returns True. The cache scoreboards log every
+  record with the simulation time it is written at, so once a cache trace
+  shows a timestamp, every scoreboard has passed all earlier timestamps.
+  mem_logger however only logs a TIME line on the first beat of a burst,
+  and appends the later beats in later cycles under that timestamp. The
+  last timestamp of the memory trace is only passed once a newer TIME line
+  follows. Only records before the largest timestamp seen in the previous
+  poll, and before the last TIME line of the memory trace, are processed;
+  the traces are polled every poll_interval seconds. While the memory is
+  not written, the check thus waits for the next write or the end of the
+  simulation.
+  """
+  n_caches = len(cache_cursors)
+  cursors = list(cache_cursors)
+  if mem_cursor is not None:
+    cursors.append(mem_cursor)
+  follow = is_done is not None
+  for cursor in cursors:
+    cursor.follow = follow
+
+  horizon = -1
+  batch = TraceBatch(n_caches)
+  while True:
+    done = (not follow) or is_done()
+    if done:
+      horizon = float("inf")
+      # Whatever was written before the marker is complete. A trace that
+      # is still missing was never written (e.g. main_mem_diff.txt without
+      # any memory write) and stays empty.
+      for cursor in cursors:
+        if os.path.exists(cursor.file):
+          cursor.follow = False
+
+    heap = []
+    for src, cursor in enumerate(cursors):
+      record = cursor.peek()
+      if record is not None:
+        heap.append((record.time, src))
+    heapify(heap)
+
+    while heap and heap[0][0] < horizon:
+      time, src = heap[0]
+      record = cursors[src].pop()
+      next_record = cursors[src].peek()
+      if next_record is None:
+        heappop(heap)
+      else:
+        heapreplace(heap, (next_record.time, src))
+
+      if src == n_caches:
+        batch.mem_records.append(record)
+      else:
+        batch.cache_records[src].append(record)
+        if record.initiator:
+          batch.retired.append((src, record.addr))
+
+      # Yield only once every record with the same timestamp was consumed.
+      # Records appended later have a timestamp of at least horizon.
+      if batch.retired and (not heap or heap[0][0] > time):
+        batch.time = time
+        yield batch
+        batch = TraceBatch(n_caches)
+
+    if done:
+      return
+    for cursor in cursors:
+      cursor.poll()
+    seen_time = max(cursor.seen_time for cursor in cursors)
+    if mem_cursor is not None and mem_cursor.seen_time >= 0:
+      # Beats of the last burst may still be appended
+      seen_time = min(seen_time, mem_cursor.seen_time)
+    if seen_time == horizon:
+      wall_time.sleep(poll_interval)
+    horizon = seen_time
@@ -1,8 +1,12 @@
 from random import choice, randrange, choices
 from enum import Enum
 from math import log2
-from common import MemoryRange
+from common import MemoryRange, DIGIT_CHARS, format_uints
 from typing import List
+from queue import Queue
+from threading import Thread
+from itertools import islice
+import numpy as np
 
 class ReadSnoopType(Enum):
   READNOSNOOP = 0
@@ -45,6 +49,10 @@ class WritePolicyHint(Enum):
   WR_POLICY_WT = 4
 
 class CacheTransaction:
+  __slots__ = (
+    "addr", "data", "op", "size", "shareability", "cached", "time"
+  )
+
   def __init__(
       self,
       addr: int,
@@ -83,6 +91,71 @@ class CacheTransaction:
     self.cached = cached
     self.time = time
 
+def transaction_dtype(data_width):
+  """Structured dtype of a batch of transactions.
+  The data bytes are stored most significant byte first."""
+  return np.dtype([
+    ("addr", "<u8"),
+    ("op", "u1"),
+    ("data", "u1", (data_width // 8,)),
+    ("size", "u1"),
+    ("shareability", "u1"),
+    ("cached", "?"),
+    ("time", "<u8"),
+  ])
+
+
+def records_from_transactions(txns, data_width):
+  """Structured array (see transaction_dtype) of CacheTransaction objects."""
+  records = np.zeros(len(txns), dtype=transaction_dtype(data_width))
+  records["addr"] = [txn.addr for txn in txns]
+  records["op"] = [txn.op.value for txn in txns]
+  records["data"] = np.frombuffer(
+    b"".join(txn.data.to_bytes(data_width // 8, "big") for txn in txns),
+    dtype=np.uint8).reshape(len(txns), data_width // 8)
+  records["size"] = [txn.size for txn in txns]
+  records["shareability"] = [txn.shareability for txn in txns]
+  records["cached"] = [txn.cached for txn in txns]
+  records["time"] = [txn.time for txn in txns]
+  return records
+
+
+# Names of the ops by value, padded with 0 bytes to the same length
+OP_NAMES = np.zeros(
+  (max(op.value for op in CacheReqOp) + 1,
+   max(len(op.name) for op in CacheReqOp)), dtype=np.uint8)
+for op in CacheReqOp:
+  OP_NAMES[op.value, :len(op.name)] = np.frombuffer(op.name.encode(), np.uint8)
+
+
+def format_transactions(records, addr_width, data_width):
+  """Vectorized formatting of a batch of transactions in the format of
+  CacheTransactionSequence.generate_file.
+  Returns the lines, each terminated by a newline, as one bytes object."""
+  n = len(records)
+
+  def text(string):
+    return np.broadcast_to(np.frombuffer(string.encode(), np.uint8),
+                           (n, len(string)))
+
+  data = records["data"].reshape(n, -1)
+  data_chars = np.stack(
+    [DIGIT_CHARS[data >> 4], DIGIT_CHARS[data & 0xf]], axis=2)
+  data_chars = data_chars.reshape(n, -1)[:, -(data_width // 4):]
+  columns = [
+    text("OPER:"), OP_NAMES[records["op"]],
+    text(" ADDR:"), format_uints(records["addr"], 16, addr_width // 4),
+    text(" DATA:"), data_chars,
+    text(" SIZE:"), format_uints(records["size"]),
+    text(" CACH:"), format_uints(records["cached"]),
+    text(" SHAR:"), format_uints(records["shareability"]),
+    text(" TIME:"), format_uints(records["time"]),
+    text("\n"),
+  ]
+  chars = np.concatenate(columns, axis=1)
+  return chars[chars != 0].tobytes()
+
+
 class CacheTransactionSequence:
   def __init__(
     self,
@@ -94,6 +167,10 @@ class CacheTransactionSequence:
     self.dw = data_width
     self.mem_ranges = mem_ranges
     self.sequence : list[CacheTransaction] = []
+    # Batches of transactions as structured arrays (see transaction_dtype),
+    # or streams of them. They are written after self.sequence. Streams
+    # are only produced while the file is written.
+    self.batches : list = []
     self.separator = " "
 
   def add_transaction(self, txn: CacheTransaction):
@@ -104,6 +181,67 @@ class CacheTransactionSequence:
       txn = self.gen_rand_transaction()
       self.sequence.append(txn)
 
+  def gen_rand_records(self, n_transactions, rng=np.random):
+    """Vectorized gen_rand_transaction, drawing from rng.
+    Returns a structured array (see transaction_dtype)."""
+    records = np.zeros(n_transactions, dtype=transaction_dtype(self.dw))
+    range_idx = rng.randint(0, len(self.mem_ranges), size=n_transactions)
+    for i, mem_range in enumerate(self.mem_ranges):
+      in_range = range_idx == i
+      records["addr"][in_range] = mem_range.get_rand_cached_shared_addrs(
+        self.dw // 8, np.count_nonzero(in_range), rng)
+    ops = np.array([op.value for op in CacheReqOp], dtype=np.uint8)
+    records["op"] = ops[rng.randint(0, len(ops), size=n_transactions)]
+    # Loads are cached, stores have a 20% chance to be uncached
+    records["cached"] = (records["op"] == CacheReqOp.REQ_LOAD.value) | \
+      (rng.random_sample(n_transactions) < 0.8)
+    records["data"] = rng.randint(
+      0, 256, size=(n_transactions, self.dw // 8), dtype=np.uint8)
+    records["size"] = int(log2(self.dw))
+    records["shareability"] = 1
+    return records
+
+  def generate_rand_batch(self, n_transactions):
+    """Vectorized generate_rand_sequence with np.random.
+    The transactions are stored as a structured array in self.batches,
+    which is also returned."""
+    records = self.gen_rand_records(n_transactions)
+    self.batches.append(records)
+    return records
+
+  def generate_rand_stream(self, n_transactions, chunk_records=1 << 16):
+    """Like generate_rand_batch, but the transactions are only generated,
+    chunk by chunk, while the file is written. The chunks are drawn from
+    a generator seeded from np.random now, so the stream does not depend
+    on other uses of np.random before the file is written."""
+    rng = np.random.RandomState(np.random.randint(0, 1 << 32, dtype=np.int64))
+    def chunks():
+      for start in range(0, n_transactions, chunk_records):
+        yield self.gen_rand_records(
+          min(chunk_records, n_transactions - start), rng)
+    self.batches.append(chunks())
+
+  def add_transaction_stream(self, txns, chunk_records=1 << 16):
+    """Add an iterable of CacheTransaction objects, which is consumed in
+    chunks while the file is written."""
+    txns = iter(txns)
+    def chunks():
+      while True:
+        chunk = list(islice(txns, chunk_records))
+        if not chunk:
+          return
+        yield records_from_transactions(chunk, self.dw)
+    self.batches.append(chunks())
+
+  def iter_record_chunks(self, chunk_records):
+    """Structured arrays of at most chunk_records of self.batches."""
+    for batch in self.batches:
+      if isinstance(batch, np.ndarray):
+        batch = [batch]
+      for records in batch:
+        for start in range(0, len(records), chunk_records):
+          yield records[start:start + chunk_records]
+
   def get_rand_mem_range(self):
     return choice(self.mem_ranges)
 
@@ -132,7 +270,7 @@ class CacheTransactionSequence:
       time=0
     )
 
-  def generate_file(self, filename):
+  def generate_file(self, filename, chunk_records=1 << 16):
     first = True
     with open(filename, "w") as file:
       for txn in self.sequence:
@@ -145,6 +283,38 @@ class CacheTransactionSequence:
           f"DATA:{txn.data:0{self.dw // 4}x} SIZE:{txn.size} "
           f"CACH:{int(txn.cached)} SHAR:{txn.shareability} TIME:{txn.time}"
         )
+    # The chunks are formatted here and written by a separate thread, so
+    # that generating and writing overlap. The queue bounds the memory use.
+    queue = Queue(maxsize=4)
+    errors = []
+    def write_lines(file, first):
+      while True:
+        lines = queue.get()
+        if lines is None:
+          return
+        if errors:
+          continue
+        try:
+          # Lines are separated, not terminated, by newlines
+          if not first:
+            file.write(b"\n")
+          first = False
+          file.write(lines[:-1])
+        except Exception as e:
+          errors.append(e)
+    with open(filename, "ab") as file:
+      writer = Thread(target=write_lines, args=(file, first))
+      writer.start()
+      try:
+        for records in self.iter_record_chunks(chunk_records):
+          if errors:
+            break
+          queue.put(format_transactions(records, self.aw, self.dw))
+      finally:
+        queue.put(None)
+        writer.join()
+    if errors:
+      raise errors[0]
 
 
 if __name__ == "__main__":